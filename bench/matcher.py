@@ -0,0 +1,38 @@
+""" Times matching string patterns against a long MIU string: all the matches with
+    the compiled matcher (imatches) and with the recursive matcher it replaced, and
+    just the first match, as Rule.run(first=True) does.
+
+    python bench/matcher.py [length]
+"""
+import sys, os, time, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo's phosphorus
+from phosphorus import ConstantVal
+from phosphorus.phival import imatches
+
+def recursive(pattern, target):
+    """ The matcher phosphorus used before imatches, which builds every match eagerly """
+    if not pattern: return [{}] if not target else []
+    head = pattern[0]
+    if ConstantVal(head).is_variable():
+        return [{head:target[0:i], **ms} for i in range(len(target)+1)
+                   for ms in recursive(pattern[1:], target[i:])
+                       if head not in ms or ms[head]==target[0:i]]
+    if not target or head != target[0]: return []
+    return recursive(pattern[1:], target[1:])
+
+def timed(f):
+    t = time.perf_counter()
+    out = f()
+    return out, time.perf_counter() - t
+
+random.seed(1)
+length = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+target = "M" + "".join(random.choice("IU") for _ in range(length - 1))
+print(f"{'pattern':8} {'matches':>8} {'recursive':>10} {'compiled':>10} {'first':>10}")
+for pattern in ["αIIIβ", "αUUβ", "MαUβIγ", "αβγ"]:
+    p = ConstantVal(pattern)
+    before, slow = timed(lambda: recursive(p, target))
+    after, fast = timed(lambda: list(imatches(p, target)))
+    _, first = timed(lambda: p.match(target, first=True))
+    assert before == after, pattern
+    print(f"{pattern:8} {len(after):>8} {slow:>9.4f}s {fast:>9.4f}s {first:>9.5f}s")
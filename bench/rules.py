@@ -0,0 +1,64 @@
+""" Checks that compiled rule outputs give the same values as substituting into them, 
+    on the example rules, and times interpreting with each.
+
+    python bench/rules.py
+"""
+import sys, os, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo's phosphorus
+from phosphorus import *
+from phosphorus.phival import memo, rules
+from phosphorus.runtime import get_runtime
+
+runtime = get_runtime()
+runtime.run('lex.update({"john": "J", "mary": "M", "smokes": [λx. x ∈ {"J"}], '
+            '"loves": [λx.[λy. ⟨y,x⟩ ∈ {⟨"J","M"⟩}]]})')
+for rule in ["rule TN: ⟦α⟧ -> lex[α] || α in lex",
+             "rule NN: ⟦tree[α]⟧ -> ⟦α⟧",
+             "rule FA1: ⟦tree[α β]⟧ -> ⟦α⟧(⟦β⟧) || isfun(⟦α⟧)",
+             "rule FA2: ⟦tree[α β]⟧ -> ⟦β⟧(⟦α⟧) || isfun(⟦β⟧)",
+             "rule OR: ⟦tree[α β γ]⟧ -> ⟦α⟧ ∨ β ∈ {john}"]:
+    runtime.run(rule)
+trees = [runtime.ev(s) for s in ["tree[[john] [[loves] [mary]]]", "tree[[mary] [smokes]]",
+                                 "tree[[[john] [smokes]]]", "tree[[john] [john] [mary]]"]]
+
+def subtrees(x):
+    yield x
+    if isinstance(x, TreeVal):
+        for child in x: yield from subtrees(child)
+
+checked = 0
+for x in {y for t in trees for y in subtrees(t)}:
+    for rule in rules.values():
+        bindings = rule.pattern.match(x)
+        if bindings is None or isinstance(bindings, list): continue
+        compiled = rule.evaluate(dict(bindings))
+        if compiled is None: continue
+        expected = rule.substitute(dict(bindings))
+        assert compiled[0] == expected, f"{rule.name} on {x}: compiled {compiled[0]!r}, substituted {expected!r}"
+        checked += 1
+
+def timed(rounds=200):
+    t = time.perf_counter()
+    for _ in range(rounds):
+        memo.clear()
+        out = [interpret(x) for x in trees[:3]]
+    return time.perf_counter() - t, out
+
+compiled_time, out = timed()
+for rule in rules.values(): rule.evaluate = lambda bindings: None # substitute instead
+substituted_time, expected = timed()
+assert out == expected, (out, expected)
+print(f"{checked} rule applications agree; interpreting {len(out)} trees 200 times: "
+      f"{compiled_time:.3f}s compiled, {substituted_time:.3f}s substituting")
+
+Rule.deregister()
+for rule in ["rule I: ⟦αI⟧ -> αIU", "rule II: ⟦Mα⟧ -> Mαα",
+             "rule III: ⟦αIIIβ⟧ -> αUβ", "rule IV: ⟦αUUβ⟧ -> αβ"]:
+    runtime.run(rule)
+checked = 0
+for y in step("MI", 6, accum=True):
+    for rule in rules.values():
+        for bindings in rule.pattern.match(y) or []:
+            assert rule.fill(bindings) == rule.output.update(bindings), (rule.name, y, bindings)
+            checked += 1
+print(f"{checked} string rule applications agree")
@@ -4,11 +4,29 @@ Preprocessor for converting phosphorus language to correct python code in two st
 replace_elements -- text converter replacing any special φ code with valid python
 ValWrapper       -- ast converter to wrap certain nodes with conversions to φ objects
 
+Both are applied by the Runtime (see runtime.py), which evaluates phosphorus code
+with or without IPython; load_ipython_extension also installs them into IPython.
+
 """
-from IPython.core.latex_symbols import latex_symbols
-import re, ast, itertools
+import re, ast, itertools, builtins, time
+from numbers import Number
+from . import phival, parse, runtime, batch
 from .phival import *
-from .parse import Span, Token, STRING, NAME, printerr, log
+from .runtime import *
+from .batch import *
+from .parse import *
+
+__all__ = [*phival.__all__, *runtime.__all__, *batch.__all__, *parse.__all__,
+    # the preprocessor
+    "ValWrapper", "replace", "replace_elements", "replace_tree", "replace_lambda",
+    "replace_comprehension", "replace_lex", "combine_multiline", "ellipsis", "escapes",
+    "escape_dict", "subs", "phi_names", "compile_time_names", "debug_transform_print",
+    "header", "load_ipython_extension", "unload_ipython_extension",
+    # modules the baseline also exported
+    "phival", "parse", "re", "ast", "itertools", "builtins", "time", "Number",
+]
+""" What "from phosphorus import *" provides: each module's __all__, and the
+    preprocessor. Phosphorus code resolves free words against this namespace. """
 
 escapes={
         ('in',  '∈', ' in '), ("'", 'ʼ', "ʼ"), ("`", 'ʼ', "ʼ"),
@@ -47,9 +65,10 @@ subs=[
 phi_names = {"TreeVal","LambdaVal", "interpret", "Rule", "SemEntity", "SemLiteral", "SemPredicate", "Span"}
 compile_time_names = set(globals()['__builtins__'].keys())
 compile_time_names.update(phi_names)
-#Note: important to not bury run_time_names inside a function call, since these are different in different contexts (especially locals(), I think)
-run_time_names = ast.parse('{**locals(), **globals(), **__builtins__.__dict__}', mode="eval").body
 """ Lists of python names NOT to convert to PhiVals """
+#Note: important to not bury these inside a function call, since these are different in different contexts (especially locals())
+run_time_namespaces = ["locals()", "globals()", "__builtins__.__dict__"]
+""" Where python names are looked up at run time, in order """
     
 
 def replace_tree(n, item, parent):
@@ -219,6 +238,18 @@ def ellipsis(fr, to):
 class ValWrapper(ast.NodeTransformer):
     """Wraps certain items in a call to φ(), replaces ranges"""
     
+    scopes = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef,
+              ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+    """ Nodes with their own local namespace """
+    depth = 0
+    """ How many scopes deep the current node is """
+    
+    def visit(self, node):
+        nested = isinstance(node, ValWrapper.scopes)
+        self.depth += nested
+        try:     return super().visit(node)
+        finally: self.depth -= nested
+    
     def wrap(self,node):
         #print("wrapping ", ast.dump(node))
         node = self.generic_visit(node)
@@ -260,14 +291,19 @@ class ValWrapper(ast.NodeTransformer):
             return node
         return self.wrap(node)
     
-    # This is the ONLY way to do this. The run_time_names must be evaluated at the same level as 
-    # the name itself in order to catch names only defined inside some block like a comprehension
+    # This is the ONLY way to do this. The namespaces must be checked at the same level as 
+    # the name itself in order to catch names only defined inside some block like a comprehension.
+    # Each namespace is checked in turn (rather than merged into one dict) so that a lookup
+    # costs a few dict probes. At the top level, locals() is just globals() and is skipped.
     def visit_Name(self, node):
         #print("visiting", node.id, "In compile_time_names", node.id in compile_time_names)
         if node.id not in compile_time_names and isinstance(node.ctx, ast.Load):
-            out = ast.IfExp(test=ast.Compare(left=ast.Str(s=node.id), ops=[ast.In()],
-                                             comparators=[run_time_names]), 
-                            body=node, orelse=self.wrap(ast.Str(s=node.id)))
+            namespaces = run_time_namespaces if self.depth else run_time_namespaces[1:]
+            test = ast.BoolOp(op=ast.Or(), values=[
+                ast.Compare(left=ast.Str(s=node.id), ops=[ast.In()],
+                            comparators=[ast.parse(ns, mode="eval").body])
+                for ns in namespaces])
+            out = ast.IfExp(test=test, body=node, orelse=self.wrap(ast.Str(s=node.id)))
             #display(ast.dump(out))
             return out
         return node
@@ -303,10 +339,9 @@ class ValWrapper(ast.NodeTransformer):
         return ast.Starred(value=ast.Call(func=ast.Name(id='ellipsis',ctx=ast.Load()), 
             args=[node.left, node.right], keywords=[]), ctx=ast.Load())
 
-ip = get_ipython() #Not entirely sure why this must be a global
 def debug_transform_print(*s):
     """ Helper function for debugging transformation """
-    try:    debug_transform = ip.ev("debug_transform")
+    try:    debug_transform = get_runtime()["debug_transform"]
     except: debug_transform = False
     if debug_transform:
         print(*s)
@@ -324,6 +359,7 @@ def unload_ipython_extension(ip):
             #print("Removing AST Transformer")
             ip.ast_transformers.remove(_x)
     del _x
+    set_runtime(None)
     
     
 def load_ipython_extension(ip):
@@ -332,6 +368,7 @@ def load_ipython_extension(ip):
     warnings.simplefilter("ignore")
     
     # Add the new tab completions
+    from IPython.core.latex_symbols import latex_symbols
     for escape, repl, _ in escapes:
         if escape: latex_symbols['\\' + escape] = repl
 
@@ -346,6 +383,9 @@ def load_ipython_extension(ip):
     
     ip.ex("from phosphorus import *; debug_transform = False")
 
+    # Evaluate phosphorus code internally in the notebook's namespace
+    set_runtime(Runtime(ip.user_ns))
+
     print(r"""
              _    _                  _    _
             | |  | |                | |  | |
@@ -361,8 +401,9 @@ def load_ipython_extension(ip):
 
     """)
     
-from IPython.core.display import HTML
-def header(s, size="h3"): display(HTML(f"<{size}>{s}</{size}>"))
+def header(s, size="h3"):
+    from IPython.display import display, HTML
+    display(HTML(f"<{size}>{s}</{size}>"))
 
 if __name__ == "__main__":
     ip = get_ipython()
@@ -0,0 +1,141 @@
+""" Interpreting many trees, or checking a function on many entities, across a pool of processes """
+import pickle
+from numbers import Number
+from .phival import interpret, rules, lex, memo, TreeVal, PhiVal, noerr
+from .parse import Span
+from .runtime import get_runtime
+
+__all__ = ["interpret_many"]
+
+def structure(x):
+    """ A hashable key identifying the structure of x, even if its leaves can't be hashed """
+    if isinstance(x, TreeVal):
+        return ("tree", str(x.name), tuple(structure(child) for child in x))
+    return (type(x).__name__, str(x))
+
+def interpret_many(trees, workers=None, **kwargs):
+    """ Interprets each of trees (with bindings kwargs), returning the results in the
+        same order. An item that can't be interpreted holds its exception instead of
+        aborting the batch.
+
+        Identical subtrees across the whole batch are interpreted only once, level
+        by level from the leaves up. With workers > 1, each level is spread across
+        a pool of that many processes, which start from the current rules and
+        lexicon, and the other names in the namespace that hold phosphorus values
+        or plain data (see namespace). Their results are merged back into the memo.
+    """
+    bindings = tuple(kwargs.items())
+
+    # Find the unique subtrees of the batch, grouped by height
+    unique, heights, levels = {}, {}, {}
+    def add(x):
+        key = structure(x)
+        if key not in unique:
+            children = [add(child) for child in x] if isinstance(x, TreeVal) else []
+            heights[key] = 1 + max((heights[c] for c in children), default=0) if children else 0
+            unique[key] = x
+            levels.setdefault(heights[key], []).append(key)
+        return key
+    keys = [add(x) for x in trees]
+
+    results = {} # key -> output or exception
+    if workers is None or workers <= 1:
+        for height in sorted(levels):
+            for key in levels[height]:
+                try:    results[key] = interpret(unique[key], raise_errors=True, print_errors=False, **kwargs)
+                except Exception as e: results[key] = e
+        return [results[key] for key in keys]
+
+    from concurrent.futures import ProcessPoolExecutor
+    entries = {} # key -> ((output, rule), dependencies) for subtrees computed so far
+    with ProcessPoolExecutor(workers, initializer=_setup, 
+                             initargs=(dict(rules), dict(lex), namespace())) as pool:
+        for height in sorted(levels):
+            tasks = []
+            for key in levels[height]:
+                x = unique[key]
+                # send along the results for x's children, so they aren't redone
+                seeds = [((child, bindings), *entries[structure(child)]) for child in x
+                         if structure(child) in entries] if isinstance(x, TreeVal) else []
+                tasks.append((x, seeds, kwargs))
+            chunksize = max(1, len(tasks) // (4 * workers))
+            for key, (value, deps, error) in zip(levels[height], pool.map(_work, tasks, chunksize=chunksize)):
+                if error is not None:
+                    results[key] = error
+                    continue
+                entries[key] = (value, deps)
+                results[key] = value[0]
+                memo.save("interpret", (unique[key], bindings), value, deps)
+    return [results[key] for key in keys]
+
+def ext_members(f, domain, workers):
+    """ Returns the members of the list domain that f is true of (as in ext), checked
+        in chunks across a pool of workers processes, or None if f can't be sent to
+        them. The workers start from the current rules and lexicon, and the rest of
+        the namespace that can be sent (see namespace), since f may use names through
+        the lexicon as well as directly. Raises the first error a worker ran into.
+    """
+    try:    pickle.dumps(f)
+    except Exception: return None
+    if not domain: return []
+    
+    from concurrent.futures import ProcessPoolExecutor
+    size = -(-len(domain) // (4 * workers)) # about 4 chunks per worker
+    chunks = [domain[i:i+size] for i in range(0, len(domain), size)]
+    with ProcessPoolExecutor(workers, initializer=_setup, 
+                             initargs=(dict(rules), dict(lex), namespace())) as pool:
+        results = list(pool.map(_extwork, [(f, chunk) for chunk in chunks]))
+    
+    out = []
+    for members, deps, error in results:
+        if error is not None: raise error
+        memo.depend(*deps)
+        out.extend(members)
+    return out
+
+def namespace():
+    """ The names in the current namespace, other than phosphorus's own and IPython's,
+        whose values are phosphorus values or plain data that can be sent to workers """
+    import phosphorus
+    out = {}
+    for name, value in get_runtime().namespace.items():
+        if name.startswith("_") or name in ("In", "Out") or getattr(phosphorus, name, None) is value:
+            continue
+        if isinstance(value, (PhiVal, Span, str, Number, tuple, list, set, frozenset)):
+            try:    pickle.dumps(value); out[name] = value
+            except Exception: pass
+    return out
+
+def _setup(rules_, lex_, names=None):
+    """ Installs the rules, lexicon and other names of the main process in a worker """
+    if names: get_runtime().namespace.update(names)
+    rules.clear()
+    rules.update(rules_) # rebuilds Rule.index
+    dict.clear(lex) # bypasses Lex's messages
+    dict.update(lex, lex_)
+    memo.disk = None # the main process's connection can't be shared
+    memo.clear()
+    memo.grammar_changed()
+
+def _work(task):
+    """ Interprets one subtree in a worker, returning ((output, rule), dependencies, error) """
+    x, seeds, kwargs = task
+    for key, value, deps in seeds:
+        memo.save("interpret", key, value, deps)
+    try:
+        interpret(x, raise_errors=True, print_errors=False, **kwargs)
+    except Exception as e:
+        return None, None, e
+    key = (x, tuple(kwargs.items()))
+    return memo.stores["interpret"].get(key), memo.deps.get(("interpret", key), frozenset()), None
+
+def _extwork(task):
+    """ Checks f on a chunk of the domain in a worker, returning (members, dependencies, error) """
+    f, chunk = task
+    frame = memo.track(None)
+    try:
+        return [x for x in chunk if noerr(f,x)], frame - {("input", None)}, None
+    except Exception as e:
+        return None, None, e
+    finally:
+        memo.untrack(frame)
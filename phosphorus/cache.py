@@ -0,0 +1,137 @@
+""" Small bounded caches used to avoid recomputing phosphorus work """
+from collections import OrderedDict
+import sys, pickle
+
+def approxsize(x, depth=3):
+    """ Rough size of x in bytes, including what it contains (to a limited depth).
+        Shared substructures are counted each time they appear. """
+    size = sys.getsizeof(x)
+    if depth:
+        if isinstance(x, dict):
+            size += sum(approxsize(k, depth-1) + approxsize(v, depth-1) for k, v in x.items())
+        elif isinstance(x, (tuple, list, set, frozenset)):
+            size += sum(approxsize(y, depth-1) for y in x)
+    return size
+
+class LRUCache(OrderedDict):
+    """ A dictionary holding at most maxsize entries (None for no limit), and, if
+        maxbytes is given, at most about maxbytes bytes as estimated by sizeof.
+        When over budget, the least recently used entries are discarded, calling
+        onevict(key, value) for each one if it is set. Lookups through get() are
+        counted as hits or misses, so the cache can be inspected with stats().
+    """
+    _missing = object()
+
+    def __init__(self, maxsize=4096, maxbytes=None, sizeof=approxsize):
+        super().__init__()
+        self.maxsize  = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof   = sizeof
+        self.sizes    = {} # key -> estimated size, only kept with a byte budget
+        self.bytes    = 0
+        self.hits = self.misses = self.evictions = 0
+        self.onevict  = None
+
+    def get(self, key, default=None):
+        value = super().get(key, LRUCache._missing)
+        if value is LRUCache._missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.bytes -= self.sizes.pop(key, 0)
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxbytes is not None:
+            self.sizes[key] = size = self.sizeof(key) + self.sizeof(value)
+            self.bytes += size
+        self.evict()
+
+    # Sizes are popped wherever entries can leave, since OrderedDict's pop may or
+    # may not go through __delitem__
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.bytes -= self.sizes.pop(key, 0)
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        self.bytes -= self.sizes.pop(key, 0)
+        return value
+
+    def popitem(self, last=True):
+        key, value = super().popitem(last)
+        self.bytes -= self.sizes.pop(key, 0)
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def evict(self):
+        """ Discards least recently used entries until the cache is within budget """
+        while len(self) and (
+                (self.maxsize is not None and len(self) > self.maxsize) or
+                (self.maxbytes is not None and self.bytes > self.maxbytes)):
+            key, value = self.popitem(last=False)
+            self.evictions += 1
+            if self.onevict: self.onevict(key, value)
+
+    def stats(self):
+        return {"size": len(self), "maxsize": self.maxsize,
+                "bytes": self.bytes if self.maxbytes is not None else None,
+                "maxbytes": self.maxbytes, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.stats()})"
+
+class SQLiteStore(object):
+    """ A persistent key-value store kept in a SQLite file, for caching results
+        across sessions. Keys are strings; values are pickled, and values that
+        can't be pickled (or unpickled) are simply not cached.
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)")
+        self.hits = self.misses = self.writes = 0
+
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        try:
+            if row is None: raise KeyError(key)
+            value = pickle.loads(row[0])
+        except Exception:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        try: data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception: return
+        self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?)", (key, data))
+        self.writes += 1
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def clear(self):
+        self.db.execute("DELETE FROM cache")
+
+    def close(self):
+        self.db.close()
+
+    def stats(self):
+        return {"path": self.path, "size": len(self), "hits": self.hits,
+                "misses": self.misses, "writes": self.writes}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.stats()})"
@@ -2,6 +2,9 @@ from tokenize import tokenize, untokenize, TokenInfo, TokenError
 from token import *
 from io import BytesIO
 import time
+from .cache import LRUCache
+
+__all__ = ["Span", "Token", "STRING", "NAME", "printerr", "log", "debugging", "errors_on"]
 
 class Token():
     def __init__(self, typ, string, spacebefore=""):
@@ -14,6 +17,8 @@ class Token():
     def __repr__(self): return self.string
     
     def debugstr(self): return f"{self.string}::{tok_name[self.type]} (spaces:{self.spacebefore})"
+    
+    def copy(self): return Token(self.type, self.string, self.spacebefore)
 
     def value(self):
         #TODO: fix these imports
@@ -84,6 +89,97 @@ class Span(list):
     
     def printlen(self):
         return len([o for o in self if o.string])
+    
+    def copy(self):
+        """ A copy of the span that shares no tokens or subspans with it """
+        span = Span()
+        span.type = self.type
+        span.spaceafter = self.spaceafter
+        span.extend(x.copy() for x in self)
+        return span
+    
+    def flat(self):
+        """ The span with any undelimited subspans (left by update) spliced in, 
+            as if it had been parsed again from its text """
+        span = Span()
+        span.type = self.type
+        span.spaceafter = self.spaceafter
+        for x in self:
+            if isinstance(x, Span) and not (len(x) and x[0].isdelim()):
+                span.extend(x.flat())
+            else: span.append(x)
+        return span
+    
+    def enclose(self, spacebefore=""):
+        """ The span for the code (self), like Span.parse(spacebefore + f"({self})") """
+        inner = Span()
+        inner.append(Token(OP, "(", spacebefore))
+        inner.extend(self)
+        inner.append(Token(OP, ")"))
+        span = Span()
+        span.append(inner)
+        return span
+    
+    def fromvalue(value, spacebefore=""):
+        """ Returns the span for the code str(value), like Span.parse(spacebefore + str(value)),
+            but built from the parts of value where possible, so that substituting 
+            values into code doesn't require tokenizing their text again """
+        from .phival import TreeVal, LambdaVal, SpanVal
+        if isinstance(value, SpanVal): value = value.span
+        span = Span()
+        if isinstance(value, Span):
+            value = value.copy()
+            if len(value) and isinstance(value[0], Token) and value[0].isopendelim():
+                span.append(value)
+            else:
+                span.type = value.type
+                span.extend(value)
+        
+        elif isinstance(value, TreeVal) and (not value.name or f"_{value.name}".isidentifier()):
+            # tree[_name child child ...]
+            inner = Span()
+            inner.append(Token(OP, "["))
+            if value.name: inner.append(Token(NAME, f"_{value.name}"))
+            for n, child in enumerate(value):
+                inner.extend(Span.fromvalue(child, " " if n or value.name else ""))
+            inner.append(Token(OP, "]"))
+            span.extend([Token(NAME, "tree"), inner])
+            
+        elif isinstance(value, LambdaVal):
+            # [λx∈type: guard. body], with the environment substituted as in its repr
+            err_status = errors_on(False)
+            inner = Span()
+            inner.type = "lambda"
+            inner.extend([Token(OP, "["), Token(OP, "λ")])
+            for n, arg in enumerate(value.args):
+                if n: inner.append(Token(OP, ","))
+                inner.append(Token(NAME, str.__str__(arg), " " if n else ""))
+                typ = getattr(arg, "typ", None)
+                if typ:
+                    inner.append(Token(ERRORTOKEN, "∈"))
+                    inner.extend(Span.fromvalue(typ))
+            if value.guard is not None:
+                inner.append(Token(OP, ":"))
+                inner.extend(Span.fromvalue(value.guard.update(value.env), " "))
+            inner.append(Token(OP, "."))
+            inner.extend(Span.fromvalue(value.body.update(value.env)))
+            inner.append(Token(OP, "]"))
+            errors_on(err_status)
+            span.append(inner)
+            
+        else:
+            text = str(value)
+            if text.isidentifier() and not text.startswith("λ"):
+                span.append(Token(NAME, text))
+            elif isinstance(value, int) and text.isascii() and text.isdigit():
+                span.append(Token(NUMBER, text))
+            else:
+                return Span.parse(spacebefore + text)
+        
+        for first in span.leaves():
+            first.spacebefore = spacebefore + first.spacebefore
+            break
+        return span
         
     #Idea: instead of just the lambdas, eval each Span as possible?
     def update(self,subs):
@@ -106,13 +202,12 @@ class Span(list):
                 s = item.string
                 spaces = item.spacebefore
                 #item = ConstantVal(s).update(subs)                
-                item = subs[item.string]
+                item = value = subs[item.string]
                 DEBUGGING and mylog(f"Replacing {s} -> {item}::{type(item)}")
                 if not isinstance(item, LambdaVal):
-                    #s = get_ipython().transform_cell(str(item)).strip() #remove final newline
-                    s = str(item) #Problem if we want to use keywords as ConstantVals?
-                    DEBUGGING and mylog(f"|{item}| transforms to |{s}|")
-                    item = Span.parse(spaces + s)
+                    #Problem if we want to use keywords as ConstantVals?
+                    item = Span.fromvalue(value, spaces)
+                    DEBUGGING and mylog(f"|{value}| transforms to |{item}|")
                     # logic for add parens if necessary
                     outerParens = ( # check for surrounding delimiters in self
                             self[n - 1].string in Token.delims and
@@ -126,7 +221,7 @@ class Span(list):
                     )
                     if not (outerParens or onlyItem or singleItem):
                         # add surrounding parens if needed
-                        item = Span.parse(spaces + "(" + s + ")")
+                        item = Span.fromvalue(value).enclose(spaces)
                     DEBUGGING and mylog(f"Parsed: |{item}|") #Costly
                     if item.printlen() == 1: item = item[0]
             
@@ -139,29 +234,32 @@ class Span(list):
                 
             if isinstance(item, LambdaVal):
                 DEBUGGING and mylog("Found lambda " + str(item))
+                applied = False
                 if peek is not None:
                     DEBUGGING and mylog(f"Next item: {peek}::{type(peek)}")
                     if isinstance(peek, Span) and peek[0].string == "(":
                         peek = peek.update(subs) #apply bindings to args of lambda
-                        item = item.sub({item.args[0] : peek.ev(False, False)}) #Basically run the func without checking types/domain restrictions
+                        #Basically run the func without checking types/domain restrictions
+                        body = item.body.update({**item.env, item.args[0] : peek.ev(False, False)}).flat()
                         outerParens = ( # check for surrounding delimiters in self
                             self[n - 1].string in Token.delims and
                             len(self) > n + 2 and
                             self[n + 2].string == Token.delims[self[n - 1].string]
                         )
                         onlyItem = len(self) == 2 and n == 0 # check if lambda call is the only thing in self
-                        sp = Span.parse(item)
                         singleItem = ( #check if we have one item or item(...) or item[...]
-                            len(sp) == 1 or
-                            (len(sp) == 2 and isinstance(sp[1], Span))
+                            len(body) == 1 or
+                            (len(body) == 2 and isinstance(body[1], Span))
                         )
+                        item = body
                         if not (outerParens or onlyItem or singleItem):
                             # add surrounding parens if needed
-                            item = "(" + item + ")"
+                            item = body.enclose()
+                        applied = True
                         next(enum) #skip the arg
 
                 DEBUGGING and mylog("Finally" + str(item))
-                item = Span.parse(str(item))
+                if not applied: item = Span.fromvalue(item)
                 #span.append(item)
                 #item = Span.parse("(" + ",".join(f"{key}={value}" for key,value in subs.items()) + ")")[0]
                 DEBUGGING and mylog("Adding " + str(item) + " to lambda")
@@ -196,13 +294,11 @@ class Span(list):
 #         return out
 
     def ev(self, print_errors = True, throw_errors = False):
-        ip = get_ipython()
-        s = f"try: _out = {self}\n"\
-            f'except Exception as e: _out = e'
-        #print("Evaluating string", s, "in", self.debugstr())
+        from .runtime import get_runtime
+        #print("Evaluating string", self, "in", self.debugstr())
         
-        ip.run_cell(s, silent=True)
-        out = ip.ev("_out")
+        try: out = get_runtime().ev(str(self))
+        except Exception as e: out = e
         #print(f"Got {out}::{type(out)}; =self:{out==self}")
         
         if isinstance(out, Exception):
@@ -228,8 +324,28 @@ class Span(list):
             if throw_errors: raise e
             return self     # Base case 3: Unexpected exception
         
-    ignores = {INDENT, ENDMARKER, DEDENT, ENCODING}
+    cache = LRUCache(4096)
+    """ parsed spans, keyed by (text, substitutions); parse hands out copies, 
+        so the cached spans are never changed. See Span.cache.stats() """
+    
     def parse(g,delim=None,span=None,subs={}):
+        """ Parses the string or token generator g into a (nested) Span """
+        if not isinstance(g, str) or delim is not None:
+            return Span.tokenparse(g, delim, span, subs)
+        
+        try:    key = (g, tuple(subs.items())); parsed = Span.cache.get(key)
+        except TypeError: key = parsed = None # unhashable substitutions
+        if parsed is None:
+            parsed = Span.tokenparse(g, subs=subs)
+            if key is not None: Span.cache[key] = parsed
+        parsed = parsed.copy()
+        if span is None: return parsed
+        if parsed.type: span.type = parsed.type
+        span.extend(parsed)
+        return span
+    
+    ignores = {INDENT, ENDMARKER, DEDENT, ENCODING}
+    def tokenparse(g,delim=None,span=None,subs={}):
         if span is None: span = Span()
         def cleanup(g):
             """ Ignores non-printing tokens, but fixes spacing issues and 
@@ -289,7 +405,7 @@ class Span(list):
 
             elif tok.isopendelim():
                 #print("Open delim " + tok.string)
-                subspan = Span.parse(g,tok,subs=subs)
+                subspan = Span.tokenparse(g,tok,subs=subs)
                 span.append(subspan)
 
             else: raise SyntaxError(f"Unmatched delimiter: {tok.debugstr()}")
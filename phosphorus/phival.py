@@ -1,29 +1,106 @@
 """ Defines various kinds of PhiVals for storing Phosphorus Values """
-from graphviz import Graph
 from numbers import Number
 import builtins; import ast
 import re; import time
+import hashlib, itertools
+from collections.abc import Set, Iterable
 
 from .parse import Span, errors_on, log, debugging
+from token import NAME, NUMBER
+from .runtime import get_runtime
+from .cache import LRUCache, SQLiteStore
 
-ip = get_ipython()
-""" ip is the ipython object, provides useful methods """
-rules = {}
-""" stores our interpretation rules """
+__all__ = [
+    "PhiVal", "ConstantVal", "NumVal", "SetVal", "BitSetVal", "TupleVal", "TreeVal",
+    "SpanVal", "LambdaVal", "SemType", "Domain", "ArbSet", "Lex", "Rule", "Derivation",
+    "DomainError", "φ", "τ", "ι", "lex", "rules", "memo", "memo_stats", "interpret",
+    "step", "steps", "derive", "repeat", "ext", "dom", "isfun", "istrue", "noerr",
+    "matches", "safe_update", "ensurelist", "map", "filter", "parseon", "eval_n",
+    "ip_eval", "ip_parse",
+]
 
 class Lex(dict):
     def __missing__(self, key):
         return key
     
+    # record lookups, so memoized values can be redone if the entry changes
+    def __getitem__(self, key):
+        memo.depend(("lex", str(key)))
+        return super().__getitem__(key)
+    
+    def __contains__(self, key):
+        memo.depend(("lex", str(key)))
+        return super().__contains__(key)
+    
+    def __setitem__(self, key, value):
+        memo.invalidate(("lex", str(key)))
+        memo.grammar_changed()
+        super().__setitem__(key, value)
+    
+    def __delitem__(self, key):
+        memo.invalidate(("lex", str(key)))
+        memo.grammar_changed()
+        super().__delitem__(key)
+    
     def update(self, *args, **kwargs):
-        global memo
-        memo = {} #redo memoization if you update the lexicon
         print(f"Updating the global lexicon 'lex' to include {args[0]}")
-        super().update(*args, **kwargs)
+        new = dict(*args, **kwargs)
+        for key in new: #redo memoization for anything that used these entries
+            memo.invalidate(("lex", str(key)))
+        memo.grammar_changed()
+        super().update(new)
 
 lex = Lex()
 """ stores our lexicon """
 
+class Rules(dict):
+    """ The rule dictionary. Any change to it, including direct ones like 
+        rules.pop(name), rebuilds the index of rule patterns (Rule.index) and redoes
+        memoization for anything that tried an old version of the rules changed, 
+        or that a new rule might now apply to. """
+    def changed(self, *names):
+        for name in names:
+            memo.invalidate(("rule", name))
+            if name in self: memo.invalidate_matches(self[name].pattern)
+        memo.grammar_changed()
+        Rule.index = RuleIndex(self)
+    
+    def __setitem__(self, name, rule):
+        super().__setitem__(name, rule)
+        self.changed(name)
+    
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.changed(name)
+    
+    def pop(self, name, *default):
+        found = name in self
+        out = super().pop(name, *default)
+        if found: self.changed(name)
+        return out
+    
+    def popitem(self):
+        out = super().popitem()
+        self.changed(out[0])
+        return out
+    
+    def setdefault(self, name, rule=None):
+        if name not in self: self[name] = rule
+        return self[name]
+    
+    def clear(self):
+        names = list(self)
+        super().clear()
+        self.changed(*names)
+    
+    def update(self, *args, **kwargs):
+        new = dict(*args, **kwargs)
+        super().update(new)
+        self.changed(*new)
+
+rules = Rules()
+""" stores our interpretation rules """
+
 
 # NOTE: the other form of greek letter phi doesn't work for some reason!
 def φ(*args, literal=False, **kwargs):
@@ -51,12 +128,170 @@ def φ(*args, literal=False, **kwargs):
 
 # global state variable for whether parsing should be shown
 parseon = False
-# memo is a dictionary mapping inputs to [dictionaries that map bindings
-# to the corresponding output and rule used to achieve that output]
-# That is, memo: [input -> [binding -> (output, rule used)]]
-memo = dict()
+printon = True
+
+class Memo(object):
+    """ Memoization of interpret and ext, kept in separate namespaces:
+        "interpret" maps (input, bindings) to (output, rule used), and
+        "ext" maps a digest of a function and domain to the function's extension.
+        Each namespace is held in its own store (by default an LRUCache, bounded
+        by maxsize entries and optionally maxbytes estimated bytes).
+        
+        Each entry also records what it depended on: ("lex", key) for lexicon
+        lookups, ("rule", name) for rules tried, and ("input", x) for every input
+        interpreted along the way, including its own. Dependencies of subcomputations
+        are added to the computations that use them, so invalidating a dependency 
+        removes the entries that used it as well as all of their ancestors.
+        
+        After persist(path), results are also saved to a SQLite file and looked up
+        there when missing from memory, so they survive kernel restarts. Disk keys
+        include a fingerprint of the current rules and lexicon, so any change to
+        either simply misses. (Results are assumed to depend on nothing else.)
+    """
+    namespaces = ("interpret", "ext")
+    
+    def __init__(self, maxsize=100000, maxbytes=None, store=LRUCache):
+        self.stores = {}
+        for ns in Memo.namespaces:
+            self.stores[ns] = store(maxsize=maxsize, maxbytes=maxbytes)
+            self.stores[ns].onevict = lambda key, value, ns=ns: self.forget(ns, key)
+        self.deps       = {} # (namespace, key) -> dependencies
+        self.dependents = {} # dependency -> {(namespace, key)}
+        self.frames     = [] # dependencies of the computations in progress
+        self.disk       = None # persistent store, if any
+        self.grammar    = None # fingerprint of rules and lex, computed when needed
+    
+    def persist(self, path="phosphorus_cache.sqlite"):
+        """ Also saves results to (and loads them from) the SQLite file at path.
+            persist(None) stops using the file. """
+        if self.disk is not None: self.disk.close()
+        self.disk = SQLiteStore(path) if path else None
+    
+    def grammar_changed(self):
+        """ Called whenever rules or lex change, so the fingerprint is recomputed """
+        self.grammar = None
+    
+    def diskkey(self, ns, key):
+        """ A content fingerprint of key in namespace ns under the current grammar """
+        if self.grammar is None:
+            h = hashlib.blake2b(digest_size=16)
+            for name in rules:
+                h.update(f"{name}:{rules[name].pattern}->{rules[name].output}\n".encode())
+            for k in lex:
+                h.update(f"{k}={dict.__getitem__(lex, k)}\n".encode())
+            self.grammar = h.hexdigest()
+        if ns == "interpret":
+            x, bindings = key
+            key = "|".join([fingerprint(x), *(f"{k}={fingerprint(v)}" for k,v in bindings)])
+        return hashlib.blake2b(f"{ns}|{self.grammar}|{key}".encode(), digest_size=16).hexdigest()
+    
+    def configure(self, maxsize=None, maxbytes=None, namespace=None):
+        """ Changes the budget of one namespace (or all), evicting entries if needed """
+        for ns in [namespace] if namespace else Memo.namespaces:
+            store = self.stores[ns]
+            if maxsize is not None: store.maxsize = maxsize
+            if maxbytes is not None:
+                if store.maxbytes is None: # start estimating sizes
+                    for key in store:
+                        store.sizes[key] = store.sizeof(key) + store.sizeof(store[key])
+                    store.bytes = sum(store.sizes.values())
+                store.maxbytes = maxbytes
+            store.evict()
+    
+    def get(self, ns, key):
+        """ Returns the stored value for key (None if there isn't one), recording
+            that it was used by the computation in progress """
+        value = self.stores[ns].get(key)
+        if value is None and self.disk is not None:
+            try:    saved = self.disk.get(self.diskkey(ns, key))
+            except: saved = None # e.g., unprintable key
+            if saved is not None:
+                value, deps = saved
+                self.save(ns, key, value, deps, disk=False)
+        if value is not None:
+            self.depend(*self.deps.get((ns, key), ()))
+        return value
+    
+    def depend(self, *deps):
+        """ Records deps for the computation in progress, if any """
+        if self.frames: self.frames[-1].update(deps)
+    
+    def track(self, x):
+        """ Starts recording the dependencies of a computation for input x """
+        frame = {("input", x)}
+        self.frames.append(frame)
+        return frame
+    
+    def untrack(self, frame):
+        """ Stops recording frame, passing its dependencies on to the enclosing computation """
+        # frames are nested, but remove by identity in case of an unmatched track
+        n = max(n for n, f in enumerate(self.frames) if f is frame)
+        del self.frames[n]
+        self.depend(*frame)
+    
+    def save(self, ns, key, value, deps=(), disk=True):
+        """ Stores value for key in namespace ns, along with its dependencies """
+        self.discard(ns, key)
+        self.deps[(ns, key)] = deps = frozenset(deps)
+        for dep in deps:
+            self.dependents.setdefault(dep, set()).add((ns, key))
+        self.stores[ns][key] = value
+        if disk and self.disk is not None:
+            try:    self.disk[self.diskkey(ns, key)] = (value, deps)
+            except: pass # e.g., unprintable key
+    
+    def forget(self, ns, key):
+        """ Removes the dependency records of an entry """
+        for dep in self.deps.pop((ns, key), ()):
+            keys = self.dependents.get(dep)
+            if keys is not None:
+                keys.discard((ns, key))
+                if not keys: del self.dependents[dep]
+    
+    def discard(self, ns, key):
+        """ Removes an entry """
+        self.stores[ns].pop(key, None)
+        self.forget(ns, key)
+    
+    def invalidate(self, dep):
+        """ Removes every entry that depended on dep """
+        for key in self.dependents.pop(dep, set()):
+            self.discard(*key)
+    
+    def invalidate_matches(self, pattern):
+        """ Removes entries for inputs that pattern matches, and their ancestors """
+        for x in {x for x, _ in self.stores["interpret"]}:
+            try:    matched = pattern.match(x) is not None
+            except: matched = True
+            if matched: self.invalidate(("input", x))
+    
+    def clear(self):
+        for store in self.stores.values(): store.clear()
+        self.deps.clear()
+        self.dependents.clear()
+    
+    def __len__(self):
+        return sum(len(store) for store in self.stores.values())
+    
+    def stats(self):
+        out = {ns : store.stats() for ns, store in self.stores.items()}
+        out["dependencies"] = len(self.dependents)
+        if self.disk is not None: out["disk"] = self.disk.stats()
+        return out
+
+def fingerprint(x):
+    """ Text identifying the content of x (trees print structurally, unlike repr) """
+    return f"{type(x).__name__}:{x}"
+
+memo = Memo()
+""" memoized results of interpret and ext """
+
+def memo_stats():
+    """ Reports the size, hits, misses and evictions of each memo namespace """
+    return memo.stats()
+
 def interpret(x, showparse=None, memoize=True, raise_errors=False, print_errors=True, **kwargs):
-    global parseon, memo
+    global parseon, printon, interning
     # tuple of bindings coming from kwargs, used for memoization
     bindings = tuple(kwargs.items())
 
@@ -69,20 +304,34 @@ def interpret(x, showparse=None, memoize=True, raise_errors=False, print_errors=
         # when parsing should be shown, memo is reset so that
         # everything gets computed by hand
         if showparse and memoize:
-            memo = dict()
+            memo.clear()
+
+    # likewise, errors inside a call that doesn't print them aren't printed
+    if not print_errors:
+        oldprint, printon = printon, False
+        olderrors = errors_on(False)
 
+    frame = None # dependencies of this computation, for memoization
+    interning += 1 # share equal values while interpreting (see interned)
     # try/finally so that parseon state will always be reset at the end
     try:
         out = None # will be the output of a rule applied to x
         r   = None # will be the rule applied to x
         
         # try to use memoization to avoid recomputing
-        if memoize and x in memo and bindings in memo[x]:
-            out, r = memo[x][bindings]
+        saved = memo.get("interpret", (x, bindings)) if memoize else None
+        if saved is not None:
+            out, r = saved
         # if the previous if clause didn't happen, we need to compute the interpretation
         else:
-            # get all results of applying rules to x
-            results   = [(r, rules[r].run(x, **kwargs)) for r in rules]
+            frame = memo.track(x)
+            # get all results of applying rules to x, skipping rules that can't
+            # apply if another rule has (so only overlapping rules are evaluated)
+            results   = []
+            for r in Rule.index.candidates(x):
+                if any(o is not None and Rule.index.isdisjoint(u, r) for u,o in results): continue
+                memo.depend(("rule", r))
+                results.append((r, rules[r].run(x, **kwargs)))
             outputs   = [o for (_,o) in results if o is not None]
             rulesused = [r for (r,o) in results if o is not None]
 
@@ -96,7 +345,7 @@ def interpret(x, showparse=None, memoize=True, raise_errors=False, print_errors=
             out, r = outputs[0], rulesused[0]
         
         # show parsing if output was actually computed
-        if parseon and not (memoize and x in memo):
+        if parseon and frame is not None:
             from IPython.display import display_html
             try: res = out._repr_html_()
             except: res = out
@@ -105,20 +354,23 @@ def interpret(x, showparse=None, memoize=True, raise_errors=False, print_errors=
     
     # don't raise ValueErrors if raise_errors is turned off
     except ValueError as e:
-        if print_errors: print(f"ERROR: {e}")
+        if print_errors and printon: print(f"ERROR: {e}")
         if raise_errors: raise e
         out = None
     finally:
         # set state of parseon back to what it was before this call
         if showparse is not None:
             parseon = oldparse
+        if not print_errors:
+            printon = oldprint
+            errors_on(olderrors)
+        if frame is not None:
+            memo.untrack(frame)
+        interning -= 1
     
     # save values for future
-    if memoize:
-        if x in memo:
-            memo[x][bindings] = (out, r)
-        else:
-            memo[x] = {bindings: (out, r)}
+    if memoize and frame is not None:
+        memo.save("interpret", (x, bindings), (out, r), frame)
     
     return out
 
@@ -128,58 +380,199 @@ def ensurelist(x):
     """
     return x if isinstance(x, (frozenset, set, list, tuple)) else [x]
 
-def step(x, n=1, accum=False, showrules=False, **kwargs):
+def successors(y, **kwargs):
+    """ Yields (rule name, output) for each output of each rule that applies to y """
+    for r in Rule.index.candidates(y):
+        out = rules[r].run(y, **kwargs)
+        if out is None: continue
+        for z in ensurelist(out): yield r, z
+
+def steps(x, n=None, accum=True, max_states=None, max_length=None, showrules=False, **kwargs):
+    """ Streams the outputs of applying rules to x (as in step), one set per step:
+        first the set of starting values, then the outputs after each further rule
+        application, for n steps or until there are none left.
+        If accum == True:  each set only has the outputs not found at any earlier
+                           step, and each output is expanded just once
+        If accum == False: each set has all the outputs after exactly that many
+                           applications; the successors of the most recently
+                           expanded outputs are kept, so those aren't redone
+        Outputs whose str is longer than max_length are dropped, and it stops once
+        max_states different outputs have been found.
+    """
+    frontier = set()
+    for y in ensurelist(x):
+        if max_length is None or len(str(y)) <= max_length: frontier.add(y)
+    if max_states is not None and len(frontier) > max_states:
+        frontier = set(list(frontier)[:max_states])
+    visited = set(frontier)
+    expanded = LRUCache(steps.expanded) # output -> its successors, only kept if accum == False
+    yield frontier
+
+    i = 0
+    while frontier and (n is None or i < n) and (max_states is None or len(visited) < max_states):
+        i += 1
+        results = [] # (input, rule, output)
+        new = set()
+        for y in frontier:
+            found = expanded.get(y) if not accum else None
+            if found is None:
+                found = [(r, z) for r, z in successors(y, **kwargs)
+                         if max_length is None or len(str(z)) <= max_length]
+                if not accum: expanded[y] = found
+            for r, z in found:
+                if accum and z in visited: continue
+                if z not in visited:
+                    if max_states is not None and len(visited) >= max_states: break
+                    visited.add(z)
+                results.append((y, r, z))
+                new.add(z)
+        if showrules: show_step(i, n, results)
+        frontier = new
+        yield frontier
+
+steps.expanded = 10000
+""" how many outputs' successors steps keeps when not accumulating """
+
+def show_step(i, n, results):
+    """ Displays the rules applied at step i (of n) and their outputs """
+    from IPython.display import display_html
+    title = "Applying All Rules" if n == 1 else f"Step {i}"
+    display_html(f"<span style='width:100%; border-bottom-style:solid; border-bottom-width:thin; display:inline-block; font-weight:bold;'>{title}</span>", raw=True)
+    for y, r, z in results:
+        display_html(f"<span style='float:right; font-family:monospace'>(by {r})</span>"
+                     f"<span>{y} &rightarrow; {z}</span>", raw=True)
+
+def step(x, n=1, accum=False, showrules=False, max_states=None, max_length=None, **kwargs):
     """ Similar to interpret, but for basic formal systems like MIU.
         Finds all outputs after applying rules to x at most n times.
         If accum == False: only finds outputs after exactly n rule applications
         If showrules == True: prints out the rules being applid and the
                               resulting outputs at each step.
+        Each output is listed once. See steps to get the outputs step by step, and
+        for max_states and max_length. If max_states stops it before n steps, the
+        outputs from the last step reached are returned (with a note printed).
     """
-    # outputs is a list of sets
-    # outputs[i] is the set of outputs after n steps
-    outputs = []
-    outputs.append(set(ensurelist(x))) # after 0 steps, x is the only output
-
-    for i in range(n):
-        # for output printing, keep a dict of (input, rule) -> rule applied to input
-        # inputs come from outputs of the previous step
-        newresults = dict()
-        for y in outputs[-1]:
-            for r in rules:
-                newresults[(y,r)] = rules[r].run(y, **kwargs)
-        newresults = dict(filter(lambda pair: pair[1] is not None, newresults.items()))
-
-        if showrules:
-            from IPython.display import display_html
-            if n == 1:
-                display_html(f"<span style='width:100%; border-bottom-style:solid; border-bottom-width:thin; display:inline-block; font-weight:bold;'>Applying All Rules</span>", raw=True)
-            if n > 1:
-                display_html(f"<span style='width:100%; border-bottom-style:solid; border-bottom-width:thin; display:inline-block; font-weight:bold;'>Step {i + 1}</span>", raw=True)
-            for y,r in newresults:
-                 display_html(f"<span style='float:right; font-family:monospace'>(by {r})</span>"
-                              f"<span>{y} &rightarrow; {newresults[(y,r)]}</span>", raw=True)
-        
-        newoutputs = set()
-        for p in newresults:
-            newoutputs.update(newresults[p])
-        
-        # old steps are only needed if accumulating
-        if not accum:
-            outputs.pop(0)
-        outputs.append(newoutputs)
-
-        # display current list of results
-        """ removed this to be consistent with showparse style in interpret
-        if showrules:
-            print(f"Current values: {set.union(*outputs) if accum else outputs[-1]}")
-        """
-    
-    # outputs is now a list of sets of outputs at each step
-    final = []
-    for S in outputs:
-        final.extend(S)
+    final, count = [], 0
+    for count, S in enumerate(steps(x, n, accum=accum, max_states=max_states,
+                                    max_length=max_length, showrules=showrules, **kwargs)):
+        if accum: final.extend(S)
+        else:     final = list(S)
+    if accum or count == n: return final
+    if final: print(f"Stopped after {count} steps, at max_states={max_states}")
     return final
 
+def inverse(name):
+    """ Returns a function giving the inputs that rule name turns into a value, if
+        the rule is a string rewrite whose output mentions all its pattern's
+        variables (so can be matched backwards), or None otherwise """
+    rule = rules[name]
+    pattern, output = rule.pattern, rule.output
+    if not (isinstance(pattern, ConstantVal) and isinstance(output, ConstantVal)): return None
+    if {c for c in pattern if ConstantVal(c).is_variable()} - {c for c in output if ConstantVal(c).is_variable()}:
+        return None
+    def predecessors(z):
+        for bindings in imatches(output, z):
+            y = pattern.update(bindings)
+            # run the rule forwards to be sure, in case of guards or repeated variables
+            if z in ensurelist(rule.run(y) or []): yield y
+    return predecessors
+
+def derive(start, goal, strategy="bfs", heuristic=None, max_states=None, max_length=None, **kwargs):
+    """ Searches for the shortest way to get from start to goal by applying rules, 
+        for basic formal systems like MIU. Returns a Derivation: a list of steps
+        (value, name of the rule that produced it), empty if no derivation was found,
+        along with the number of states explored and the time taken.
+        strategy "bfs":           breadth first from start
+                 "bidirectional": breadth first from both ends, growing the smaller
+                                  frontier; running rules backwards needs every rule
+                                  to be a string rewrite (see inverse), otherwise bfs
+                                  is used instead
+                 "best_first":    expands the state with the fewest steps so far plus
+                                  heuristic(state, goal) first (A*), so the derivation
+                                  is still shortest if heuristic never overestimates
+        Stops once max_states states have been seen; states whose str is longer than
+        max_length are skipped.
+    """
+    import heapq
+    from itertools import count
+    t0 = time.perf_counter()
+    fits = lambda y: max_length is None or len(str(y)) <= max_length
+    full = lambda seen: max_states is not None and seen >= max_states
+    def path(parents, y):
+        out = []
+        while y is not None:
+            prev, r = parents[y]
+            out.append((y, r)); y = prev
+        return out[::-1]
+    def done(steps, explored):
+        return Derivation(steps, strategy, explored, time.perf_counter() - t0)
+    
+    if strategy == "bidirectional":
+        backward = {r: inverse(r) for r in rules}
+        if None in backward.values(): strategy = "bfs"
+    elif strategy not in ("bfs", "best_first"):
+        raise ValueError(f"Unknown strategy {strategy!r}: use 'bfs', 'bidirectional' or 'best_first'")
+    
+    parents = {start: (None, None)} # state -> (previous state, rule)
+    if start == goal: return done(path(parents, start), 1)
+    
+    if strategy == "bfs":
+        frontier, explored = [start], 0
+        while frontier and not full(len(parents)):
+            new = []
+            for y in frontier:
+                explored += 1
+                for r, z in successors(y, **kwargs):
+                    if z in parents or not fits(z): continue
+                    parents[z] = (y, r)
+                    if z == goal: return done(path(parents, z), explored)
+                    new.append(z)
+            frontier = new
+        return done([], explored)
+    
+    if strategy == "best_first":
+        heuristic = heuristic or (lambda y, goal: 0)
+        depth, ties, explored = {start: 0}, count(), 0
+        queue = [(heuristic(start, goal), next(ties), 0, start)]
+        while queue and not full(len(parents)):
+            _, _, d, y = heapq.heappop(queue)
+            if d > depth[y]: continue # since found a shorter way
+            if y == goal: return done(path(parents, y), explored)
+            explored += 1
+            for r, z in successors(y, **kwargs):
+                if not fits(z) or depth.get(z, depth[y] + 2) <= depth[y] + 1: continue
+                depth[z] = depth[y] + 1; parents[z] = (y, r)
+                heapq.heappush(queue, (depth[z] + heuristic(z, goal), next(ties), depth[z], z))
+        return done([], explored)
+    
+    # bidirectional: children maps each state reached from the goal to (next state, rule)
+    children = {goal: (None, None)}
+    ahead, behind, explored = [start], [goal], 0
+    while ahead and behind and not full(len(parents) + len(children)):
+        forwards = len(ahead) <= len(behind)
+        new = []
+        for y in (ahead if forwards else behind):
+            explored += 1
+            found = successors(y, **kwargs) if forwards else \
+                    ((r, z) for r in backward for z in backward[r](y))
+            for r, z in found:
+                if not fits(z): continue
+                if forwards and z not in parents:
+                    parents[z] = (y, r); new.append(z)
+                elif not forwards and z not in children:
+                    children[z] = (y, r); new.append(z)
+                else: continue
+                if z in (children if forwards else parents):
+                    steps = path(parents, z)
+                    after, r = children[z]
+                    while after is not None:
+                        steps.append((after, r))
+                        after, r = children[after]
+                    return done(steps, explored)
+        if forwards: ahead = new
+        else:        behind = new
+    return done([], explored)
+
 def repeat(f,x,n,accum=False):
     """ Recursively applies f to x, n times.
         If accum == False: returns the value of f(f(f(...f(x))))
@@ -243,8 +636,22 @@ class PhiVal(object):
         #print("PhiVal call of "); display(out)
         return out
     
+    # PhiVals compare by structure, never by rendering. Those built on python values
+    # (ConstantVal, NumVal, SetVal, TupleVal) use the python comparison; the rest
+    # define structure(), a hashable summary of what they are made of.
+    def structure(self):
+        return tuple(map(structure, self.parts()))
+    
     def __eq__(self, other):
-        return repr(self) == repr(other)
+        if self is other: return True
+        if type(self) is not type(other): return False
+        return self.structure() == other.structure()
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash(self.structure())
     
     def __rshift__(self,other):
         return [self,other]
@@ -264,10 +671,105 @@ class PhiVal(object):
         except:
             return self
         
+def structure(x):
+    """ A hashable key for x, equal for structurally equal values """
+    if isinstance(x, PhiVal) and not isinstance(x, (str, int, tuple, frozenset)):
+        return (type(x), x.structure())
+    try:
+        hash(x)
+        return (type(x), x)
+    except TypeError: # e.g. SemLiterals, which can't be compared
+        return (type(x), str(x))
+
+def concrete(x):
+    """ Whether x is an actual value, rather than (partly) unevaluated code """
+    from .semval import SemLiteral
+    return not isinstance(x, (Span, SpanVal, SemLiteral))
+
+def quotes_names(span):
+    """ Whether span uses the text of its names rather than their values (nested
+        lambdas and ` lexicon lookups), so it can't be run as a function of them """
+    return span.type == "lambda" or any(
+        quotes_names(x) if isinstance(x, Span) else x.string in ("`", "λ") for x in span)
+
+def compile_code(span, names):
+    """ Compiles the code in span into a python function of names, or returns None if
+        that would change its meaning. The code is transformed exactly as Span.ev would
+        transform it: the function is refused if the transformation reads part of it
+        differently (as a comprehension, say) once it is the body of a lambda. """
+    from ast import Lambda, walk, ListComp, SetComp, DictComp, GeneratorExp
+    runtime, code = get_runtime(), str(span).strip()
+    comps = lambda tree: sum(isinstance(node, (ListComp, SetComp, DictComp, GeneratorExp))
+                             for node in walk(tree))
+    source = f"lambda {', '.join(names)}: {code}"
+    fn = runtime.parse(source, "eval").body
+    if not isinstance(fn, Lambda) or comps(fn.body) != comps(runtime.parse(code, "eval")):
+        return None
+    return runtime.ev(source)
+
+truth_ops = {"∧", "∨", "¬", "∈", "∉", "⊆", "⊂", "⊇", "⊃", "→", "↔", "==", "!=", "<", ">",
+             "<=", ">=", "not", "in", "is"}
+""" operators whose result is a truth value (type t); and/or give one of their operands """
+
+def spantype(span, types={}):
+    """ Works out the semantic type of the code in span from its tokens, without 
+        evaluating it, or returns None if it can't. types gives the types of variables.
+        Handles lambdas (using their annotations), truth-valued operators, names (of
+        variables, lexicon entries after `, values in the namespace, or constants) and
+        function application. """
+    items = [x for x in span if isinstance(x, Span) or x.string]
+    if not items: return None
+    if len(items) == 1 and isinstance(items[0], Span):
+        inner = items[0]
+        if inner.type == "lambda": return LambdaVal.parse(inner).statictype(types)
+        if inner[0].string == "(": return spantype(inner[1:-1], types)
+        return None
+    tokens = {x.string.strip() for x in items if not isinstance(x, Span)}
+    if tokens & {"if", "else", "lambda", "for"}: return None # its value needn't be a truth value
+    if tokens & {"and", "or"}:
+        # these bind loosest, and give one of their operands, so type those
+        operands, operand = [], []
+        for x in items:
+            if not isinstance(x, Span) and x.string.strip() in ("and", "or"):
+                operands.append(operand); operand = []
+            else: operand.append(x)
+        types = {spantype(operand, types) for operand in [*operands, operand]}
+        return types.pop() if len(types) == 1 else None
+    if tokens & truth_ops: return ConstantVal("t")
+    
+    # a name or lambda, applied to any number of arguments
+    head, args = items[0], items[1:]
+    if isinstance(head, Span):
+        out = spantype([head], types)
+    elif head.string == "`" and args and not isinstance(args[0], Span):
+        name, args = args[0].string, args[1:]
+        out = τ(lex[name]) if name in lex else None
+    elif head.type == NAME:
+        namespace = get_runtime().namespace
+        if head.string in types:       out = types[head.string]
+        elif head.string in namespace: out = τ(namespace[head.string])
+        else:                          out = τ(ConstantVal(head.string))
+    elif head.type == NUMBER:
+        out = τ(NumVal(head.string))
+    else: return None
+    
+    for arg in args:
+        if not (isinstance(arg, Span) and arg[0].string == "("): return None
+        if not isinstance(out, tuple) or len(out) != 2: return None
+        out = out[1]
+    return out if out != "constant" else None
+
+class DomainError(ValueError):
+    """ Raised when a lambda is applied to an argument its guard excludes """
+
 class LambdaVal(PhiVal):
     def __init__(self, args, body, guard=None, env={}):
         self.args = args; self.body = body; self.guard = guard; self.env = env
         self.stype = None
+        self.compiled = None
+        
+    def __getstate__(self):
+        return {**self.__dict__, "compiled": None} # compiled functions can't be pickled
         
     def __repr__(self):
         #print("Lambda body " + self.sub())
@@ -278,12 +780,36 @@ class LambdaVal(PhiVal):
         errors_on(err_status)
         return out
     
+    def structure(self):
+        return (tuple((str(a), str(getattr(a, "typ", None))) for a in self.args),
+                str(self.body), str(self.guard),
+                frozenset((str(k), structure(v)) for k,v in self.env.items()))
+    
     def __call__(self, *args, **kwargs):
         def mylog(s): log(s,"LambdaVal.__call__")
         if kwargs:
             [kwargs.pop(arg,"") for arg in self.args]
             return LambdaVal(self.args, self.body, self.guard, {**self.env, **kwargs})
         
+        # Run the compiled guard and body if they give actual values
+        compiled = self.compile() if len(args) == len(self.args) else None
+        if compiled:
+            values, guard, body = compiled
+            out = None
+            try:    inside = guard(*values, *args) if guard else 1
+            except Exception as e: # as for a guard that doesn't evaluate below
+                raise DomainError(f"Not in the domain: {args}") from e
+            if concrete(inside) and not inside:
+                raise DomainError(f"Not in the domain: {args}")
+            if concrete(inside):
+                # an error means the body has no actual value (symbolic arguments,
+                # or a lambda applied outside its domain, which substituting allows),
+                # so fall back on substituting into it
+                try:    out = (body(*values, *args),)
+                except Exception: pass
+                if out is not None and concrete(out[0]): return out[0]
+            mylog("Compiled lambda gave no value; substituting into the body instead")
+        
         # TODO: mesh with "sub" function below?
         bindings = {**self.env} #Copy the env dictionary
         bindings.update(dict(zip(self.args, args)))
@@ -292,13 +818,13 @@ class LambdaVal(PhiVal):
 #        if SemType.type(args[0]) != self.semtype()[0]:
 #            raise ValueError(f"{args[0]} is wrong type; should be {self.semtype()[0]}")
         
-        if self.guard is not None:
+        if self.guard is not None and not (compiled and concrete(inside)):
             s = self.guard.update(bindings)
             mylog(f"Checking guard {s}")
             out = s.ev_n()
             mylog(f"Checking guard {s}\nGot output {out}::{type(out)}")
             if isinstance(out, Span) or not out:
-                raise ValueError(f"Not in the domain: {args}")
+                raise DomainError(f"Not in the domain: {args}")
         
         s = self.body.update(bindings) #self.sub(bindings)
         mylog("Lambda output: " + s.debugstr() + " Evaled " + str(s.ev_n()))
@@ -341,16 +867,66 @@ class LambdaVal(PhiVal):
             if curr.isdelim(): break
             body.append(curr)
         
-        return LambdaVal((arg,), body, guard) 
+        out = LambdaVal((arg,), body, guard)
+        out.stype = out.statictype()
+        return out
         #return f'LambdaVal(("""{arg}""",),"""{str(body).lstrip()}""","""{guard}""")'
     
+    def compile(self):
+        """ Compiles the guard and body (once) into python functions of the names in
+            env and the arguments. Returns (env values, guard, body), or None if the
+            code quotes its names and so has to be run by substituting into the spans.
+        """
+        if self.compiled is None:
+            self.compiled = False
+            try:
+                args = [str.__str__(a) for a in self.args]
+                env  = [k for k in self.env if str.__str__(k) not in args]
+                names = [*(str.__str__(k) for k in env), *args]
+                parts = [self.body] if self.guard is None else [self.guard, self.body]
+                if all(n.isidentifier() for n in names) and not any(map(quotes_names, parts)):
+                    fns = [compile_code(p, names) for p in parts]
+                    if None not in fns:
+                        guard = fns[0] if self.guard is not None else None
+                        self.compiled = ([self.env[k] for k in env], guard, fns[-1])
+            except Exception as e:
+                log(f"Could not compile {self.body}: {e}", "LambdaVal.compile")
+        return self.compiled or None
+    
     def sub(self, bindings={}):
         subs = {**self.env}
         subs.update(bindings)
         return str(self.body.update(subs))
         
+    def statictype(self, types={}):
+        """ The type of the lambda worked out from its tokens (see spantype), or None.
+            types gives the types of variables around it. """
+        try:
+            types = {**types, **{str.__str__(k): τ(v) for k,v in self.env.items()}}
+            ta = self.argtype()
+            out = spantype(self.body, {**types, str.__str__(self.args[0]): ta})
+            return TupleVal([ta,out]) if out is not None else None
+        except Exception as e:
+            log(f"No static type for {self.body}: {e}", "LambdaVal.statictype")
+            return None
+        
+    def argtype(self):
+        """ The type the argument is annotated with (e by default). An annotation naming
+            a set or domain in the namespace, rather than a type, gives its members' type. """
+        # not τ of the argument, since its name may also be an entity
+        typ = getattr(self.args[0], "typ", None)
+        if typ is None or typ == "constant": return ConstantVal("e")
+        if isinstance(typ, ConstantVal) and str(typ) not in SemType.D:
+            value = get_runtime().namespace.get(str(typ))
+            if isinstance(value, (Set, Domain)):
+                types = {τ(x) for x in value}
+                if len(types) == 1: return types.pop()
+        return typ
+    
     def semtype(self):
+        if not self.stype: self.stype = self.statictype()
         if not self.stype:
+            # last resort: evaluate the body and look at the result
             err_status = errors_on(False) #suppress errors while calculating type TODO: use with
             try:
                 ta = τ(self.args[0])
@@ -372,7 +948,23 @@ class LambdaVal(PhiVal):
     def type(self):
         return "λ"
         
+interned = LRUCache(10000)
+""" canonical instances of ConstantVals, NumVals and TreeVals made while interpreting, 
+    keyed by structure, so equal values built separately share one instance (and trees
+    one cached hash), across calls to interpret. Only the most recently used are kept;
+    values that have dropped out are still equal, just not shared. """
+interning = 0
+""" how many calls to interpret are in progress """
+
 class NumVal(int,PhiVal):
+    def __new__(cls, x=0):
+        if cls is not NumVal or not interning: return super().__new__(cls, x)
+        value = int(x)
+        instance = interned.get((cls, value))
+        if instance is None:
+            instance = interned[(cls, value)] = super().__new__(cls, value)
+        return instance
+    
 #  def __repr__(self):
 #    if self.is_integer(): return str(int(self))
 #    return self
@@ -448,13 +1040,249 @@ class SetVal(frozenset,PhiVal):
         return bindings
             
 
+class Domain(object):
+    """ A collection of entities with fast membership tests. It is given by either
+        - a list (or other iterable) of its members, which are indexed by position
+          so that subsets of it can be stored as bitmasks (see BitSetVal), or
+        - for large or generated domains, a lazy source: a range, or a function
+          returning a fresh iterator of the members, optionally with a membership
+          test contains(x). Lazy domains are iterated on demand and only indexed
+          (all at once) if something needs their positions or has no other way to
+          test membership.
+        Members are converted with φ. Use Domain.of to share one Domain per list of
+        entities, and Domain.load to read one from a file.
+    """
+    def __init__(self, items=(), contains=None, lazy=None, name=None):
+        self.source   = items
+        self.contains = contains
+        self.lazy = lazy if lazy is not None else \
+                    callable(items) or isinstance(items, range) or contains is not None
+        self.name = name
+        self.serial = next(Domain.serials)
+        self._items = self._index = self._fingerprint = None
+        if not self.lazy: self.items # index eagerly
+
+    def of(items):
+        items = tuple(items)
+        domain = Domain.cache.get(items)
+        if domain is None: domain = Domain.cache[items] = Domain(items)
+        return domain
+    
+    def load(path, contains=None):
+        """ A lazy domain with the members listed in the file at path, one per line """
+        def lines():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip(): yield line.strip()
+        return Domain(lines, contains, lazy=True, name=path)
+    
+    def iterate(self):
+        """ The raw members, from the source """
+        return iter(self.source() if callable(self.source) else self.source)
+    
+    @property
+    def items(self):
+        if self._items is None: self._items = [φ(x) for x in self.iterate()]
+        return self._items
+    
+    @property
+    def index(self):
+        if self._index is None: self._index = {x:i for i,x in enumerate(self.items)}
+        return self._index
+    
+    @property
+    def full(self): return (1 << len(self.items)) - 1
+    
+    def mask(self, xs):
+        """ The bitmask of the members of xs that are in the domain """
+        index = self.index
+        bits = 0
+        for x in xs:
+            try: i = index.get(x)
+            except TypeError: continue
+            if i is not None: bits |= 1 << i
+        return bits
+    
+    def members(self, bits):
+        while bits:
+            low = bits & -bits
+            yield self.items[low.bit_length() - 1]
+            bits ^= low
+    
+    def fingerprint(self):
+        """ A short digest identifying the members, for memo keys. The members of a lazy
+            domain aren't known without iterating it, so its digest is particular to 
+            this Domain (a domain declared again gets a new one) """
+        if self._fingerprint is None:
+            if self.lazy and self._items is None:
+                source = self.name or getattr(self.source, "__qualname__", None) or repr(self.source)
+                text = f"{source}#{getattr(self.contains, '__qualname__', self.contains)}#{self.serial}"
+            else: text = "\x00".join(map(str, self.items))
+            self._fingerprint = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        return self._fingerprint
+    
+    def __iter__(self):
+        if self._items is not None: return iter(self._items)
+        return builtins.map(φ, self.iterate())
+    
+    def __len__(self):
+        if self._items is None and hasattr(self.source, "__len__"): return len(self.source)
+        return len(self.items)
+    
+    def __bool__(self): return self.lazy or bool(self.items)
+    
+    def __contains__(self, x):
+        try:
+            if self.contains is not None: return bool(self.contains(x))
+            if self.lazy and self._index is None and isinstance(self.source, (range, set, frozenset, dict)):
+                return x in self.source
+            return x in self.index
+        except TypeError: return False
+    
+    def __repr__(self):
+        if self.name: return f"Domain({self.name})"
+        if self.lazy and self._items is None: return f"Domain({self.source!r})"
+        return f"Domain({self.items!r})"
+
+Domain.cache = LRUCache(16)
+""" Domains made by Domain.of, keyed by their members """
+Domain.serials = itertools.count()
+""" numbers each Domain made in this process, so lazy ones can be told apart """
+
+class Domains(dict):
+    """ The registry of semantic domains (SemType.D), mapping the name of each basic 
+        type to the Domain of its members. Assigning any collection (or Domain) to a
+        name declares it, so SemType.D["s"] = [...] adds a basic type s. Each change
+        increments version, which caches of type information can check.
+    """
+    def __init__(self, domains={}):
+        super().__init__()
+        self.version = 0
+        self.update(domains)
+        
+    def __setitem__(self, t, items):
+        if not isinstance(items, Domain): items = Domain(items)
+        super().__setitem__(str(t), items)
+        self.version += 1
+        
+    def __delitem__(self, t):
+        super().__delitem__(t)
+        self.version += 1
+        
+    def update(self, domains={}, **kwargs):
+        for t, items in {**dict(domains), **kwargs}.items(): self[t] = items
+    
+    def declare(self, t, items=(), contains=None, lazy=None):
+        """ Adds (or replaces) the basic type t with the given members (see Domain) """
+        self[t] = Domain(items, contains, lazy, name=str(t))
+        return self[t]
+
+class BitSetVal(PhiVal, Set):
+    """ A set of members of a Domain, stored as a bitmask over it. Membership,
+        cardinality, ∪, ∩, difference and complement (~) within the same domain are 
+        bit operations. Mixing it with other sets gives an ordinary SetVal, except 
+        that intersections and differences, which stay inside the domain, stay bitsets.
+        It behaves like a SetVal otherwise, and equals the SetVal with its members.
+    """
+    def __init__(self, domain, bits=0):
+        self.domain = domain
+        self.bits   = bits
+        self._hash  = None
+        
+    def __contains__(self, x):
+        try: i = self.domain.index.get(x)
+        except TypeError: return False
+        return i is not None and self.bits >> i & 1 == 1
+    
+    def __iter__(self): return self.domain.members(self.bits)
+    def __len__(self):  return bin(self.bits).count("1")
+    
+    @classmethod
+    def _from_iterable(cls, it): return SetVal(it)
+    
+    def same(self, other):
+        return isinstance(other, BitSetVal) and other.domain is self.domain
+    
+    def __and__(self, other):
+        if self.same(other): return BitSetVal(self.domain, self.bits & other.bits)
+        if not isinstance(other, Iterable): return NotImplemented
+        return BitSetVal(self.domain, self.bits & self.domain.mask(other))
+    __rand__ = __and__
+    
+    def __sub__(self, other):
+        if self.same(other): return BitSetVal(self.domain, self.bits & ~other.bits)
+        if not isinstance(other, Iterable): return NotImplemented
+        return BitSetVal(self.domain, self.bits & ~self.domain.mask(other))
+    
+    def __or__(self, other):
+        if self.same(other): return BitSetVal(self.domain, self.bits | other.bits)
+        return Set.__or__(self, other)
+    __ror__ = __or__
+    
+    def __xor__(self, other):
+        if self.same(other): return BitSetVal(self.domain, self.bits ^ other.bits)
+        return Set.__xor__(self, other)
+    __rxor__ = __xor__
+    
+    def __invert__(self):
+        return BitSetVal(self.domain, self.domain.full ^ self.bits)
+    
+    def __eq__(self, other):
+        if self.same(other): return self.bits == other.bits
+        return Set.__eq__(self, other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self): # the same as the equal frozenset's
+        if self._hash is None: self._hash = Set._hash(self)
+        return self._hash
+    
+    def __reduce__(self): # pickled as an ordinary set, without its domain
+        return (SetVal, (list(self),))
+    
+    def structure(self): return frozenset(self)
+    
+    def update(self, bindings):
+        out = SetVal(self).update(bindings)
+        return self if out == self else out
+    
+    def match(self, target, variables=[]):
+        return SetVal(self).match(target, variables)
+    
+    __call__ = SetVal.__call__; __getitem__ = SetVal.__getitem__
+    __repr__ = SetVal.__repr__; type = SetVal.type
+
 class TupleVal(tuple, PhiVal):
+    def __eq__(self, other):
+        if isinstance(other, TreeVal): return False
+        return tuple.__eq__(self, other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    __hash__ = tuple.__hash__
+    
     def __repr__(self):
         return "⟨" + repr(list(self))[1:-1] + "⟩"
     
     def type(self):
         return "⟨⟩"
 
+class Derivation(TupleVal):
+    """ The steps ⟨⟨start, None⟩, ⟨output, rule name⟩, ..., ⟨goal, rule name⟩⟩ of a
+        derivation found by derive, or no steps if none was found. Also records the
+        strategy used, how many states it explored, and the time taken in seconds.
+    """
+    def __new__(cls, steps=(), strategy=None, explored=0, time=0.0):
+        out = super().__new__(cls, (TupleVal(step) for step in steps))
+        out.strategy = strategy; out.explored = explored; out.time = time
+        return out
+    
+    def __repr__(self):
+        path = " ⇒ ".join(f"{y} (by {r})" if r else str(y) for y, r in self) if self else "not found"
+        return f"{path}   [{self.strategy}: {self.explored} states explored in {self.time:.3f}s]"
+
 class SpanVal(PhiVal): #Todo inherit from span? Messes up printing?
     def __init__(self, span=Span()):
         if not isinstance(span, Span):
@@ -467,6 +1295,9 @@ class SpanVal(PhiVal): #Todo inherit from span? Messes up printing?
     def semtype(self):
         return ConstantVal("t")
     
+    def structure(self):
+        return str(self.span)
+    
     def __repr__(self):
         return str(self.span)
         #return repr(self.span)
@@ -487,28 +1318,62 @@ class SpanVal(PhiVal): #Todo inherit from span? Messes up printing?
         return self.span.ev_n(self, count, print_errors, throw_errors)
     
 class TreeVal(tuple, PhiVal):
-    def __new__(cls, *children):
+    def __new__(cls, *children, name=None):
         if len(children) == 1 and isinstance(children[0], list):
             children = children[0]
         
-        name = ""
-        try:
-            if children[0].startswith("_"):
-                name = ConstantVal(children[0][1:])
-                children = children[1:]
-        except: pass
-        instance = super().__new__(cls, children)
-        instance.name = ConstantVal(name)
-        instance.svg = None
+        if name is None:
+            name = ""
+            try:
+                if children[0].startswith("_"):
+                    name = ConstantVal(children[0][1:])
+                    children = children[1:]
+            except: pass
+        name = ConstantVal(name)
+        children = tuple(children)
+        
+        # Trees are immutable, so structurally equal ones can be shared. Children that
+        # are equal but of different types (True and 1, str and ConstantVal) aren't.
+        key = (cls, name, children, tuple(builtins.map(type, children))) if interning else None
+        try:    instance = interned.get(key) if key is not None else None
+        except TypeError: key = instance = None # unhashable children
+        if instance is None:
+            instance = super().__new__(cls, children)
+            instance.name = name
+            instance._hash = None
+            if key is not None:
+                instance._hash = hash((name, tuple.__hash__(instance)))
+                interned[key] = instance
         return instance
+    
+    def __hash__(self):
+        if self._hash is None: self._hash = hash((self.name, tuple.__hash__(self)))
+        return self._hash
+    
+    # Trees are equal when their names and children are; interned trees are
+    # usually caught by the identity check
+    def __eq__(self, other):
+        if self is other: return True
+        if not isinstance(other, TreeVal): return False
+        return self.name == other.name and tuple.__eq__(self, other)
+    
+    def __ne__(self, other):
+        return not self == other
         
     def parts(self): return iter([self.name, *self])
+    
+    def __reduce__(self):
+        # rebuild through __new__, which expects the name as a "_" first child
+        return (TreeVal, ([f"_{self.name}", *self],))
 
-    #issue: if whole self is replaced, will still try to replace name
     def update(self, bindings):
-        up = super().update(bindings) #headless copy
-        up.name = self.name.update(bindings) if self.name else self.name
-        return up
+        if self in bindings: return bindings[self]
+        try:
+            children = [x.update(bindings) for x in self]
+        except:
+            return self
+        name = self.name.update(bindings) if self.name else self.name
+        return TreeVal(children, name=name)
         
     def match(self, target, variables=[]):
         #print("TreeVal match", self, target, variables)
@@ -532,41 +1397,8 @@ class TreeVal(tuple, PhiVal):
 #         return f"TreeVal({name}{children})"
     
     def _repr_svg_(self):
-        if self.svg: return self.svg
-
-        out = Graph()
-        graph_attr = {
-            "fontsize": "12", "label": "", "labelloc": "t", "splines": "line",
-            "nodesep": "0.15", "ranksep": "0.15", "margin": "0"}
-        out.attr("graph", **graph_attr)
-
-        node_attr = {
-            "fontsize": "12", "shape": "plaintext", "height": "0.25", "margin": "0"}
-        out.attr("node", **node_attr)
-
-        edge_attr = {
-            "headport": "n", "tailport": "s"}
-        out.attr("edge", **edge_attr)
-        
-        def add_node(node, parent=None):
-            tree = isinstance(node, TreeVal)
-            label = node.name if tree else repr(node)
-            label = label.strip() if label else ""
-
-            node_attr = dict()
-            if not label: node_attr["height"] = "0"
-            out.node(str(id(node)), label, **node_attr)
-            
-            if parent:
-                edge_attr = dict()
-                if len(parent) == 1: edge_attr["weight"] = "100"
-                out.edge(str(id(parent)), str(id(node)), **edge_attr)
-            
-            if tree: map(lambda n: add_node(n, node), node)
-        
-        add_node(self)
-        self.svg = out._repr_svg_()
-        return self.svg
+        from .render import svg
+        return svg(self)
     
     """ Necessary because Jupyter displays items using repr, not str, and trees
         should be displayed as svgs in the output of cells.
@@ -575,18 +1407,31 @@ class TreeVal(tuple, PhiVal):
     
     
 class ConstantVal(str, PhiVal):
+    def __new__(cls, s=""):
+        # Subclasses can carry extra attributes (SemVar.typ, SemLiteral.stype), 
+        # so only plain ConstantVals are shared
+        if cls is not ConstantVal or not interning: return super().__new__(cls, s)
+        s = str(s)
+        instance = interned.get((cls, s))
+        if instance is None:
+            instance = interned[(cls, s)] = super().__new__(cls, s)
+        return instance
+    
     def parts(self):
         length = len(self)
         return iter([self[i:j] for i in range(length) for j in range(i+1, length+1)])
     
-    def match(self, target, variables=[]):
+    def match(self, target, variables=[], first=False):
+        """ Matches against target, returning a list of all the possible bindings 
+            for string patterns (just the first if first is set), or None """
         #print("ConstantVal match 1", self, target, variables)
         bindings = super().match(target,variables)
         if bindings is not None: return bindings
         #print("ConstantVal match", self, target, variables)
         if isinstance(target, str):
-            bs = matches(self, target, variables)
-            if bs: return bs #bs[0] if len(bs)==1 else bs
+            found = imatches(self, target, variables)
+            bs = [next(found, None)] if first else list(found)
+            if bs and bs[0] is not None: return bs #bs[0] if len(bs)==1 else bs
         return None
     
     def update(self, bindings):
@@ -622,22 +1467,45 @@ class ConstantVal(str, PhiVal):
         return lex[self]
 
 class SemType(TupleVal):
-    D = {
+    D = Domains({
         'e' : ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z'],
         't' : [0,1]
-    }
+    })
+    """ The domain of each basic type; see Domains """
     
     metamarkers = "_ʼ"
     
-    # TODO: memoize or otherwise streamline
+    cache = LRUCache(10000)
+    """ types of values, keyed by (class, value); emptied whenever SemType.D changes """
+    cached = None
+    """ the (registry, version) of SemType.D the cache was filled for """
+    
     def type(x):
         if x is None:
             return ConstantVal('t') # small hack for uninterpretable lambda bodies
         
-        from .semval import SemLiteral
+        from .semval import SemLiteral, SemVar
         if isinstance(x, SemLiteral): # can't check equality of SemLiterals
             return ConstantVal("t") 
-
+        
+        # Lambdas and code keep their own types, and SemVars differ by their typ
+        if isinstance(x, (LambdaVal, SpanVal, SemVar, Span)): return SemType.infer(x)
+        
+        state = (id(SemType.D), getattr(SemType.D, "version", None))
+        if SemType.cached != state:
+            SemType.cache.clear()
+            SemType.cached = state
+        try:
+            key = (x.__class__, x)
+            out = SemType.cache.get(key, SemType)
+        except TypeError: # unhashable
+            return SemType.infer(x)
+        if out is SemType:
+            out = SemType.cache[key] = SemType.infer(x)
+        return out
+    
+    def infer(x):
+        """ Works out the type of x (see SemType.type, which caches these) """
         for t in SemType.D:
             if x in SemType.D[t]: return ConstantVal(t)
             
@@ -684,20 +1552,56 @@ class Rule(object):
         
         self.output = output
         #print(f"Rule output is {output}::{type(output)}")
+        
+        # Compile the output once, so running the rule needn't substitute into it
+        self.compiled = {}
+        self.names = {t.string for t in output.leaves() if t.type == NAME} if isinstance(output, Span) else set()
+        self.compile(sorted(n for n in self.names if ConstantVal(n).is_variable()))
+        self.template = compile_pattern(output) if isinstance(output, ConstantVal) and len(output) > 1 else None
         Rule.register(self)
     
-    def run(self,target,**kwargs):
+    def compile(self, names=()):
+        """ Compiles the (code) output into a python function of the values of names
+            (once for each list of names), or returns None if it quotes its names
+            and so has to be run by substituting into the output """
+        key = tuple(names)
+        if key not in self.compiled:
+            self.compiled[key] = None
+            try:
+                if isinstance(self.output, Span) and all(n.isidentifier() for n in key) \
+                   and not quotes_names(self.output):
+                    self.compiled[key] = compile_code(self.output, key)
+            except Exception as e:
+                log(f"Could not compile {self.output}: {e}", "Rule.compile")
+        return self.compiled[key]
+    
+    def fill(self, bindings):
+        """ The (string) output with the variables in bindings filled in """
+        if self.template is None: return self.output.update(bindings)
+        return ConstantVal("".join(str(bindings.get(text, text)) if isvar else text 
+                                   for isvar, text, _ in self.template))
+    
+    def __getstate__(self):
+        return {**self.__dict__, "compiled": {}} # compiled functions can't be pickled
+    
+    def run(self,target,first=False,**kwargs):
+        """ Applies the rule to target, returning None if it doesn't match. A string 
+            pattern can match in several ways, giving a list of outputs, or with 
+            first set, a list of the output of the first match only. """
         def mylog(s): log(s,"Rule.run")
         DEBUGGING = mylog("ENTER Rule.run")
 
-        bindings = self.pattern.match(target)
+        if first and isinstance(self.pattern, ConstantVal):
+            bindings = self.pattern.match(target, first=True)
+        else:
+            bindings = self.pattern.match(target)
         if bindings is None: return None
         # REDO with dictstr: ??
         #DEBUGGING and mylog(f"Running Rule {self.name} with Bindings: {bindings}")#; time.sleep(1)
         
         if isinstance(bindings, list):
             DEBUGGING and mylog(f"Rule {self} received a list of binding (lists)")
-            out = [self.output.update(bs) for bs in bindings]
+            out = [self.fill(bs) for bs in bindings]
             #out = out[0] if len(out) == 1 else out
             return out if out else None
                     
@@ -705,46 +1609,169 @@ class Rule(object):
         for k in bindings: DEBUGGING and mylog(f"{k} : {bindings[k]}") #refactor with dictstr?
         
         bindings.update(kwargs) #add the parameters to the bindings
+        
+        out = self.evaluate(bindings)
+        if out is not None: return out[0]
+        mylog(f"Compiled output of {self.name} gave no value; substituting instead")
+        out = self.substitute(bindings)
+        DEBUGGING and mylog(f"{self.name} -> {out}::{type(out)}")
+        return out
+    
+    def evaluate(self, bindings):
+        """ Runs the compiled output with bindings, returning (output,), with None as
+            the output if it raised an error, or None if it isn't compiled or gave
+            no actual value """
+        values = {str(k): v for k, v in bindings.items() if str(k) in self.names}
+        compiled = self.compile(sorted(values)) if isinstance(self.output, Span) else None
+        if not compiled: return None
+        try:    out = compiled(*(values[n] for n in sorted(values)))
+        except Exception: return (None,) # as substitute does
+        return (out,) if concrete(out) else None
+    
+    def substitute(self, bindings):
+        """ Substitutes bindings into the output and evaluates it, or returns None if
+            that raised an error """
         out = self.output.update(bindings)
         #print(f"Out pre-φ is {out}::{type(out)}")
         #out = φ(out) #ensure it's a phival
         #print(f"Out pre-eval is {out}::{type(out)}")
         try:
             if not hasattr(out, "ev_n"):
-                out = Span.parse(str(out))
+                out = Span.fromvalue(out)
             out = out.ev_n(print_errors = False, throw_errors=True)
             if isinstance(out,Span): out = SpanVal(out)
         #except AttributeError: pass
         except: return None
-                
-        DEBUGGING and mylog(f"{self.name} -> {out}::{type(out)}")
         return out
     
     def register(self):
-        global memo
-        memo = {} # Reset memoization with new rule
         print(f"Rule {self.name} added to global rule dictionary 'rules'")
-        rules[self.name] = self
+        rules[self.name] = self # redoes memoization this rule affects
     
     def deregister(name=None):
-        if not name: print("Deleting all rules"); rules.clear()
+        if not name: print("Deleting all rules"); rules.clear(); memo.clear()
         elif name in rules: print("Deleting " + name); del rules[name]
         else: print("Could not find rule " + name)
         
     def __repr__(self):
         return self.name + ": " + str(self.pattern) + " -> " + str(self.output)
 
+class RuleIndex(object):
+    """ A discrimination tree over the patterns of a rule dictionary, so that only
+        rules whose pattern could possibly match a target need to be run.
+        
+        Patterns are flattened in preorder into keys: ("tree", arity) and ("name", s)
+        for a tree and its name, ("const", s) for a constant, and WILD for anything
+        that could match more than one shape (variables, strings with variables,
+        sets, tuples, unnamed trees' names). Targets are flattened the same way,
+        and a WILD in a pattern skips the whole corresponding target subtree.
+        
+        The index also records which pairs of rules are disjoint, i.e., have
+        patterns that no target can match at once.
+    """
+    WILD = "*"
+    LEAF = "$"
+    
+    def __init__(self, rules={}):
+        self.root  = {}
+        self.order = {name : n for n, name in enumerate(rules)}
+        self.disjoint = {name : set() for name in rules}
+        for name in rules:
+            node = self.root
+            for key in RuleIndex.pattern_keys(rules[name].pattern):
+                node = node.setdefault(key, {})
+            node.setdefault(RuleIndex.LEAF, []).append(name)
+        
+        names = list(rules)
+        for n, a in enumerate(names):
+            for b in names[n+1:]:
+                if not RuleIndex.overlaps(rules[a].pattern, rules[b].pattern):
+                    self.disjoint[a].add(b)
+                    self.disjoint[b].add(a)
+    
+    def head_keys(p):
+        """ The keys for pattern p, not including its children """
+        if isinstance(p, TreeVal):
+            name = p.name
+            return [("tree", len(p)), 
+                    RuleIndex.WILD if not name or any(ConstantVal(c).is_variable() for c in name)
+                        else ("name", str(name))]
+        if type(p) is ConstantVal and not any(ConstantVal(c).is_variable() for c in p):
+            return [("const", str(p))]
+        return [RuleIndex.WILD]
+            
+    def pattern_keys(p, keys=None):
+        if keys is None: keys = []
+        keys.extend(RuleIndex.head_keys(p))
+        if isinstance(p, TreeVal):
+            for child in p: RuleIndex.pattern_keys(child, keys)
+        return keys
+    
+    def overlaps(p, q):
+        """ Returns False only if no target can match both patterns p and q. 
+            Repeated variables are ignored, so this errs on the side of overlap. """
+        hp, hq = RuleIndex.head_keys(p), RuleIndex.head_keys(q)
+        if RuleIndex.WILD in (hp[0], hq[0]): return True
+        if hp[0] != hq[0]: return False # different constants, arities, or kinds
+        if isinstance(p, TreeVal):
+            if RuleIndex.WILD not in (hp[1], hq[1]) and hp[1] != hq[1]: return False
+            return all(RuleIndex.overlaps(a, b) for a, b in zip(p, q))
+        return True
+    
+    def isdisjoint(self, a, b):
+        """ True if rules a and b can never both match the same target """
+        return b in self.disjoint.get(a, ())
+    
+    def target_keys(x, keys, ends):
+        """ Flattens x into keys. ends[i] is where the subtree starting at i ends.
+            Values other than trees and strings get the key None, since they might
+            still match constants by equality. """
+        start = len(keys)
+        ends.append(None)
+        if isinstance(x, TreeVal):
+            keys.append(("tree", len(x)))
+            keys.append(("name", str(x.name))); ends.append(start + 2)
+            for child in x: RuleIndex.target_keys(child, keys, ends)
+        else:
+            keys.append(("const", str(x)) if isinstance(x, str) else None)
+        ends[start] = len(keys)
+    
+    def candidates(self, x):
+        """ Returns the names of the rules that might match x, in rule order """
+        if not isinstance(x, (TreeVal, str)): return list(self.order)
+        keys, ends = [], []
+        RuleIndex.target_keys(x, keys, ends)
+        
+        found = []
+        def walk(node, i):
+            if i == len(keys):
+                found.extend(node.get(RuleIndex.LEAF, ()))
+                return
+            if RuleIndex.WILD in node: walk(node[RuleIndex.WILD], ends[i])
+            if keys[i] is None: # try every constant here
+                for key in node:
+                    if isinstance(key, tuple) and key[0] == "const": walk(node[key], i + 1)
+            elif keys[i] in node: walk(node[keys[i]], i + 1)
+        walk(self.root, 0)
+        
+        return sorted(found, key=self.order.get)
+    
+Rule.index = RuleIndex()
+""" index of the patterns in rules, rebuilt whenever rules are (de)registered """
+
         
 def map(f, i):
     if isinstance(i, list) or isinstance(i, tuple):
         return tuple(builtins.map(f,i))
-    if isinstance(i, set) or isinstance(i, frozenset):
+    if isinstance(i, (set, frozenset, BitSetVal)):
         return frozenset(builtins.map(f,i))
     return builtins.map(f,i)
 
 def filter(f, i):
     if isinstance(i, list) or isinstance(i, tuple):
         return tuple(builtins.filter(f,i))
+    if isinstance(i, BitSetVal):
+        return i & builtins.filter(f,i)
     if isinstance(i, set) or isinstance(i, frozenset):
         return frozenset(builtins.filter(f,i))
     return builtins.filter(f,i)
@@ -757,27 +1784,73 @@ def safe_update(d1, d2):
     return True
 
 def matches(pattern, target, variables):
-    if not pattern: return [{}] if not target else [] # empties match with no vars
-    
-    head = pattern[0]
-    if ConstantVal(head).is_variable(variables): # found a variable
-        # substitute each prefix of target for var and recurse
-        return [{head:target[0:i], **ms} for i in range(len(target)+1)
-                   for ms in matches(pattern[1:], target[i:], variables) 
-                       if head not in ms or ms[head]==target[0:i] #ensure same value
-               ]
+    """ Returns a list of all the ways to match string pattern against target (see imatches) """
+    return list(imatches(pattern, target, variables))
+
+_patterns = LRUCache(1024)
+""" compiled string patterns, keyed by (pattern, variables) """
+
+def compile_pattern(pattern, variables=[]):
+    """ Splits a string pattern into segments (isvariable, text, rest): a variable or
+        a run of literal text, and the length of the literal text after it """
+    segments = []
+    for c in pattern:
+        if ConstantVal(c).is_variable(variables): segments.append([True, c])
+        elif segments and not segments[-1][0]:    segments[-1][1] += c
+        else:                                     segments.append([False, c])
+    rest = 0
+    for segment in reversed(segments):
+        segment.append(rest)
+        if not segment[0]: rest += len(segment[1])
+    return [tuple(segment) for segment in segments]
+
+def imatches(pattern, target, variables=[]):
+    """ Yields each way of matching string pattern against target, as a dict binding
+        the (single character) variables of pattern to substrings of target, shortest
+        first. The pattern is compiled once; a variable seen before is checked against
+        its binding right away, and a new variable followed by literal text only tries
+        the places that text occurs, so early matches come quickly on long strings. """
+    try:    key = (str(pattern), frozenset(variables)); segments = _patterns.get(key)
+    except TypeError: key = segments = None # unhashable variables
+    if segments is None:
+        segments = compile_pattern(pattern, variables)
+        if key is not None: _patterns[key] = segments
     
-    if not target: return [] # no match    
-    if head == target[0]: # heads match
-        return matches(pattern[1:], target[1:], variables) # check tails
+    target = str(target)
+    n = len(target)
+    bindings = {}
+    def walk(k, pos):
+        if k == len(segments):
+            if pos == n: yield dict(bindings)
+            return
+        isvar, text, rest = segments[k]
+        if not isvar or text in bindings:
+            value = bindings[text] if isvar else text
+            if target.startswith(value, pos): yield from walk(k+1, pos + len(value))
+            return
+        
+        # a new variable: try each place it could end, leaving room for the text after it
+        end = n - rest
+        if k+1 == len(segments):
+            ends = [n]
+        elif not segments[k+1][0]:
+            following = segments[k+1][1]
+            ends = []
+            i = target.find(following, pos, end + len(following))
+            while i != -1:
+                ends.append(i)
+                i = target.find(following, i+1, end + len(following))
+        else:
+            ends = range(pos, end+1)
+        for i in ends:
+            bindings[text] = target[pos:i]
+            yield from walk(k+1, i)
+        bindings.pop(text, None)
     
-    return []
+    yield from walk(0, 0)
 
 def ip_parse(s, mode="eval"):
-    s = ip.transform_cell(s)
-    tree = ast.parse(s, mode=mode)
-    tree = ip.transform_ast(tree)
-    return tree
+    return get_runtime().parse(s, mode)
 
 def eval_n(s, last=None):
     if s==last: return s # Base case 1: self-evaluating expression
@@ -786,16 +1859,10 @@ def eval_n(s, last=None):
 
 #Can't remember why I returned the converted string instead of the original. 
 def ip_eval(s):
-    try:
-        code =  f"try: _out = {s}\n"\
-                f'except: _out = None' # = """{s}"""'
-        ip.run_cell(code, silent=True)
-        out = ip.ev("_out")
-        #print("Evaluating code: |" + code + "|\n yields " + str(out) + " of type " + str(type(out)))
-        return out if out != None else s
-    except Error as e: 
-        print("Exception in ip_eval" + str(e))
-        return None
+    try: out = get_runtime().ev(s)
+    except Exception: return s # non-evaluating expression
+    #print("Evaluating code: |" + s + "|\n yields " + str(out) + " of type " + str(type(out)))
+    return out if out != None else s
     
 def istrue(b,trues={1,True}):
     """Returns true if b has implemented bool, but only for 1 or True"""
@@ -809,20 +1876,128 @@ def noerr(f,*x,**k):
     #except ValueError as e: raise e # Domain Errors TODO: CHECK THIS IS OUT WITH HW4?
     except: return False
 
-def ext(f,domain=map(ConstantVal,SemType.D["e"]),memoize=True):
+def extmask(f, domain):
+    """ Computes the extension of f over the list domain in one pass, with a boolean 
+        mask over the domain (a NumPy array if NumPy is available, otherwise an int 
+        bitmask). Works for lambdas whose guard and body combine membership in known 
+        sets (x ∈ A, A(x) with A a set or another such lambda) and (in)equality with
+        x using ∧, ∨ and not. Returns None for anything else.
+    """
+    if not isinstance(f, LambdaVal) or len(f.args) != 1 or not f.compile(): return None
+    from . import ValWrapper
+    try:    import numpy
+    except ImportError: numpy = None
+    
+    arg = str.__str__(f.args[0])
+    env = [k for k in f.env if str.__str__(k) != arg]
+    values = [f.env[k] for k in env]
+    params = ast.arguments(posonlyargs=[], args=[ast.arg(arg=str.__str__(k)) for k in env], 
+                           kwonlyargs=[], kw_defaults=[], defaults=[])
+    
+    if numpy is not None:
+        full = numpy.ones(len(domain), bool)
+        def member(test): return numpy.fromiter(map(test, domain), bool, len(domain))
+        def select(m): return [domain[i] for i in numpy.flatnonzero(m)]
+    else:
+        full = (1 << len(domain)) - 1
+        def member(test): return sum(1 << i for i,x in enumerate(domain) if test(x))
+        def select(m): return [x for i,x in enumerate(domain) if m >> i & 1]
+        
+    class NoMask(Exception): pass
+    
+    def value(node):
+        """ Evaluates a subexpression not involving the argument """
+        if any(isinstance(n, ast.Name) and n.id == arg for n in ast.walk(node)): raise NoMask
+        code = ast.Expression(body=ast.Lambda(args=params, body=node))
+        code = ast.fix_missing_locations(ValWrapper().visit(code))
+        return eval(compile(code, "<phosphorus>", "eval"), get_runtime().namespace)(*values)
+    
+    def isarg(node): return isinstance(node, ast.Name) and node.id == arg
+    
+    def mask(node):
+        if isinstance(node, ast.BoolOp) or isinstance(node, ast.BinOp) and \
+                isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            parts = list(map(mask, node.values if isinstance(node, ast.BoolOp) else [node.left, node.right]))
+            out = parts[0]
+            for m in parts[1:]:
+                out = out & m if isinstance(node.op, (ast.And, ast.BitAnd)) else out | m
+            return out
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not): # not ~, which is truthy for bools
+            return full ^ mask(node.operand)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            op, left, right = node.ops[0], node.left, node.comparators[0]
+            if isinstance(op, (ast.In, ast.NotIn)) and isarg(left):
+                s = value(right)
+                if not isinstance(s, (set, frozenset, BitSetVal)): raise NoMask
+                m = member(s.__contains__)
+                return m if isinstance(op, ast.In) else full ^ m
+            if isinstance(op, (ast.Eq, ast.NotEq)) and (isarg(left) or isarg(right)):
+                c = value(right if isarg(left) else left)
+                if not isinstance(c, (str, int)) or not concrete(c): raise NoMask
+                m = member(lambda x: x == c)
+                return m if isinstance(op, ast.Eq) else full ^ m
+        if isinstance(node, ast.Call) and len(node.args) == 1 and not node.keywords and isarg(node.args[0]):
+            g = value(node.func)
+            # a lambda with a guard isn't defined on the whole domain, which masks
+            # (and so "not") can't represent; every other test here is total
+            if isinstance(g, LambdaVal) and g.guard is None:
+                m = extmask(g, domain)
+                if m is not None: return member(set(m).__contains__)
+            elif isinstance(g, (SetVal, BitSetVal)) and not any(isinstance(y, tuple) for y in g):
+                return member(g.__contains__)
+        raise NoMask
+    
+    runtime = get_runtime()
+    try:
+        out = full
+        for part in (f.guard, f.body):
+            if part is None: continue
+            tree = ast.parse(runtime.transform(f"_out = {part}"))
+            out = out & mask(tree.body[0].value)
+    except Exception: return None # NoMask, or errors the scalar path should report
+    return select(out)
+
+def ext(f,domain=None,memoize=True,workers=None):
+    """ The set of members of domain (by default the entities, SemType.D["e"]) that f
+        is true of. With workers > 1, the members are checked across a pool of that
+        many processes (see batch.ext_members), unless the extension can be found
+        with masks (see extmask). Lazy domains are checked in a single pass instead.
+    """
+    if domain is None: domain = SemType.D["e"]
+    if not isinstance(domain, Domain) and not isinstance(domain, list): domain = list(domain)
     if memoize:
-        hash = f"PHIEXTHASH#{f}#{domain}"
-        if hash in memo: return memo[hash]
+        # key on a digest, since the text of f and domain can be very long
+        name = domain.fingerprint() if isinstance(domain, Domain) else domain
+        hash = hashlib.blake2b(f"{f}#{name}".encode(), digest_size=16).hexdigest()
+        out = memo.get("ext", hash)
+        if out is not None: return out
 
+    frame = memo.track(hash if memoize else None)
     try:
         # False and error inputs are excluded from the extension
-        out = SetVal([x for x in domain if noerr(f,x)])
-        if memoize: memo[hash] = out
+        if isinstance(domain, Domain) and domain.lazy:
+            out = SetVal(x for x in domain if noerr(f,x)) # one pass, without indexing
+        else:
+            universe = domain if isinstance(domain, Domain) else None
+            if universe is not None: domain = universe.items
+            out = extmask(f, domain)
+            if out is None and workers is not None and workers > 1:
+                from .batch import ext_members
+                out = ext_members(f, domain, workers)
+            if out is None: out = [x for x in domain if noerr(f,x)]
+            try:
+                universe = universe or Domain.of(domain)
+                out = BitSetVal(universe, universe.mask(out))
+            except TypeError: # unhashable entities
+                out = SetVal(out)
+        if memoize: memo.save("ext", hash, out, frame)
         return out
     except Exception as e:
         #raise e
         from .semval import SemLiteral
         return SemLiteral(f"ext({f})")
+    finally:
+        memo.untrack(frame)
     
 def ι(f, domain=None):
     try:
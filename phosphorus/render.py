@@ -0,0 +1,139 @@
+"""
+Drawing trees as SVG without external programs:
+
+svg     -- returns the SVG for a tree, from the cache or from the chosen backend
+layout  -- positions the nodes of a tree: leaves in order, parents centred over
+           their children
+draw    -- the built-in backend, writing SVG for a laid out tree directly
+dot     -- the graphviz backend (needs the graphviz package and program)
+
+"""
+from html import escape
+from itertools import count
+from .cache import LRUCache
+
+backend = "svg"
+""" "svg" for the built-in renderer, or "graphviz" to draw trees with dot """
+
+cache = LRUCache(1024)
+""" rendered SVG, keyed by (tree, backend), so equal trees are drawn only once """
+
+FONTSIZE  = 12
+CHARWIDTH = 0.6 * FONTSIZE # rough average width of a character
+LEVEL     = 28             # vertical distance between the centres of levels
+GAP       = 10             # horizontal space between neighbouring subtrees
+MARGIN    = 4
+
+def svg(tree, backend=None):
+    """ Returns the SVG drawing of tree, reusing the drawing of any equal tree """
+    backend = backend or globals()["backend"]
+    try:    key = (tree, backend); out = cache.get(key)
+    except TypeError: key = out = None # trees with unhashable leaves aren't cached
+    if out is None:
+        out = dot(tree) if backend == "graphviz" else draw(layout(tree))
+        if key is not None: cache[key] = out
+    return out
+
+def label(node):
+    """ The text shown for node: the name of a subtree or the repr of a leaf """
+    from .phival import TreeVal
+    label = node.name if isinstance(node, TreeVal) else repr(node)
+    return label.strip() if label else ""
+
+class Box(object):
+    """ A laid out node: its label, children, centre (x, y) and subtree width """
+    __slots__ = ("label", "children", "x", "y", "width")
+    def __init__(self, label, children):
+        self.label = label; self.children = children
+        self.x = self.y = 0
+        span = sum(c.width for c in children) + GAP * (len(children) - 1)
+        self.width = max(len(label) * CHARWIDTH, span, 0)
+
+def layout(tree):
+    """ Returns the root Box of tree with every node positioned """
+    from .phival import TreeVal
+    def measure(node):
+        children = [measure(c) for c in node] if isinstance(node, TreeVal) else []
+        return Box(label(node), children)
+
+    def place(box, left, depth):
+        box.y = MARGIN + FONTSIZE/2 + depth * LEVEL
+        if not box.children:
+            box.x = left + box.width/2
+            return
+        span = sum(c.width for c in box.children) + GAP * (len(box.children) - 1)
+        x = left + (box.width - span)/2
+        for child in box.children:
+            place(child, x, depth+1)
+            x += child.width + GAP
+        # centre over the outer children, but keep the label inside the subtree
+        own = len(box.label) * CHARWIDTH / 2
+        box.x = (box.children[0].x + box.children[-1].x)/2
+        box.x = min(max(box.x, left + own), left + box.width - own)
+
+    root = measure(tree)
+    place(root, MARGIN, 0)
+    return root
+
+def draw(root):
+    """ Writes the SVG for a laid out tree """
+    lines, texts, bottom = [], [], 0
+    def add(box):
+        nonlocal bottom
+        bottom = max(bottom, box.y)
+        if box.label:
+            texts.append(f'<text x="{box.x:.1f}" y="{box.y:.1f}" dy="0.35em">{escape(box.label)}</text>')
+        for child in box.children:
+            # edges run from under the parent's label to above the child's
+            y1 = box.y + FONTSIZE/2 + 1 if box.label else box.y
+            y2 = child.y - FONTSIZE/2 - 1 if child.label else child.y
+            lines.append(f'<line x1="{box.x:.1f}" y1="{y1:.1f}" x2="{child.x:.1f}" y2="{y2:.1f}"/>')
+            add(child)
+    add(root)
+
+    width  = root.width + 2*MARGIN
+    height = bottom + FONTSIZE/2 + MARGIN
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+            f'viewBox="0 0 {width:.1f} {height:.1f}">'
+            f'<g stroke="black" stroke-width="1">{"".join(lines)}</g>'
+            f'<g font-family="Times,serif" font-size="{FONTSIZE}" text-anchor="middle">'
+            f'{"".join(texts)}</g></svg>')
+
+def dot(tree):
+    """ Draws tree with graphviz """
+    from graphviz import Graph
+    from .phival import TreeVal
+    out = Graph()
+    graph_attr = {
+        "fontsize": "12", "label": "", "labelloc": "t", "splines": "line",
+        "nodesep": "0.15", "ranksep": "0.15", "margin": "0"}
+    out.attr("graph", **graph_attr)
+
+    node_attr = {
+        "fontsize": "12", "shape": "plaintext", "height": "0.25", "margin": "0"}
+    out.attr("node", **node_attr)
+
+    edge_attr = {
+        "headport": "n", "tailport": "s"}
+    out.attr("edge", **edge_attr)
+
+    # Equal subtrees may be the same object, so ids come from a counter, not id()
+    ids = count()
+    def add_node(node, parent=None, parent_id=None):
+        tree = isinstance(node, TreeVal)
+        node_id = str(next(ids))
+
+        node_attr = dict()
+        if not label(node): node_attr["height"] = "0"
+        out.node(node_id, label(node), **node_attr)
+
+        if parent is not None:
+            edge_attr = dict()
+            if len(parent) == 1: edge_attr["weight"] = "100"
+            out.edge(parent_id, node_id, **edge_attr)
+
+        if tree:
+            for child in node: add_node(child, node, node_id)
+
+    add_node(tree)
+    return out._repr_svg_()
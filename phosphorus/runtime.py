@@ -0,0 +1,85 @@
+"""
+The phosphorus runtime, which evaluates phosphorus code without needing IPython:
+
+Runtime     -- owns a namespace, applies replace_elements and ValWrapper itself and
+               runs the resulting code with plain exec/eval
+get_runtime -- returns the runtime used for all internal evaluation (Span.ev etc.)
+set_runtime -- replaces that runtime (done by the Jupyter extension)
+
+"""
+import ast, builtins
+from .cache import LRUCache
+
+__all__ = ["Runtime", "get_runtime", "set_runtime"]
+
+class Runtime(object):
+    """ Evaluates phosphorus code in its own namespace. A headless Runtime starts
+        from a fresh namespace containing everything in phosphorus; the Jupyter
+        extension instead wraps the kernel's user namespace.
+    """
+    def __init__(self, namespace=None, maxsize=10000):
+        if namespace is None:
+            namespace = {"__builtins__": builtins}
+            exec("from phosphorus import *; debug_transform = False", namespace)
+        self.namespace = namespace
+        self.code_cache = LRUCache(maxsize)
+        """ compiled code objects, keyed by (code text, mode) """
+
+    def transform(self, s):
+        """ Text transformation: replaces special φ notation with python code """
+        from . import replace_elements
+        if not s.endswith("\n"): s += "\n" # rule notation needs the final newline
+        return "".join(replace_elements(s.splitlines(keepends=True)))
+
+    def parse(self, s, mode="exec"):
+        """ Transforms s and parses it into a python ast wrapped by ValWrapper.
+            In "eval" mode, s must be an expression.
+        """
+        from . import ValWrapper
+        if mode == "eval":
+            # Transform as an assignment, as Span.ev used to, so that the line-based
+            # substitutions in replace_elements never see the expression at the start
+            tree = ast.parse(self.transform(f"_out = {s}"), mode="exec")
+            if len(tree.body) != 1 or not isinstance(tree.body[0], ast.Assign):
+                raise SyntaxError(f"Not an expression: {s}")
+            tree = ast.Expression(body=tree.body[0].value)
+        else:
+            tree = ast.parse(self.transform(s), mode=mode)
+        return ast.fix_missing_locations(ValWrapper().visit(tree))
+
+    def compile(self, s, mode="exec"):
+        """ Returns the compiled code for s, reusing earlier compilations of the
+            same text so that repeated evaluations skip the transformations.
+        """
+        code = self.code_cache.get((s, mode))
+        if code is None:
+            code = compile(self.parse(s, mode), "<phosphorus>", mode)
+            self.code_cache[(s, mode)] = code
+        return code
+
+    def run(self, s):
+        """ Runs the phosphorus statements in s in the namespace """
+        exec(self.compile(s), self.namespace)
+
+    def ev(self, s):
+        """ Evaluates the phosphorus expression s in the namespace and returns its
+            value. Exceptions (including SyntaxErrors) are raised to the caller.
+        """
+        return eval(self.compile(s, "eval"), self.namespace)
+
+    def __getitem__(self, name):
+        return self.namespace[name]
+
+_runtime = None
+def get_runtime():
+    """ Returns the active runtime, creating a headless one if there is none """
+    global _runtime
+    if _runtime is None: _runtime = Runtime()
+    return _runtime
+
+def set_runtime(runtime):
+    """ Makes runtime the active runtime and returns the previous one """
+    global _runtime
+    old = _runtime
+    _runtime = runtime
+    return old